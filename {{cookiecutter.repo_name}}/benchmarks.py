@@ -0,0 +1,906 @@
+''' Offline benchmarks for the data preparation code, run on synthetic CIFAR-format batches
+'''
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import pickle
+import resource
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import timeit
+import threading
+import tracemalloc
+import multiprocessing
+from contextlib import redirect_stdout
+from itertools import product
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import fire
+import numpy as np
+from PIL import Image
+
+import process_cifar
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exec_src'))
+import utils
+
+
+def make_synthetic_cifar(datapath, batch_size=10000, seed=0):
+    """ Writes random data_batch_1..5 and test_batch pickles in the CIFAR-10 python format
+    """
+    if not os.path.exists(datapath):
+        os.makedirs(datapath)
+    rng = np.random.RandomState(seed)
+    names = ['data_batch_{}'.format(i + 1) for i in range(process_cifar.NUMBER_OF_TRAINING_BATCHES)]
+    for name in names + ['test_batch']:
+        batch = {'data': rng.randint(0, 256, size=(batch_size, 3 * process_cifar.IMGSIZE ** 2)).astype(np.uint8),
+                 'labels': rng.randint(0, 10, size=batch_size).tolist()}
+        with open(os.path.join(datapath, name), 'wb') as f:
+            pickle.dump(batch, f, protocol=2)
+    return datapath
+
+
+def _reference_save_image(fname, pixData, pad):
+    # saveImage as it was before the vectorised export, one pixel at a time
+    if pad > 0:
+        pixData = np.pad(pixData, ((0, 0), (pad, pad), (pad, pad)), mode='constant', constant_values=128)
+
+    size = process_cifar.IMGSIZE + 2 * pad
+    img = Image.new('RGB', (size, size))
+    pixels = img.load()
+    for x, y in product(range(img.size[0]), range(img.size[1])):
+        pixels[x, y] = (pixData[0][y][x], pixData[1][y][x], pixData[2][y][x])
+    img.save(fname)
+
+
+def _reference_export(topath, frompath):
+    os.makedirs(topath)
+    index = 0
+    for ifile in range(1, process_cifar.NUMBER_OF_TRAINING_BATCHES + 1):
+        for _, data in process_cifar.read_train_batch(frompath, ifile):
+            _reference_save_image(os.path.join(topath, '%05d.png' % index), data, process_cifar.PAD)
+            index += 1
+
+
+def _differing_files(expected_dir, actual_dir):
+    expected, actual = sorted(os.listdir(expected_dir)), sorted(os.listdir(actual_dir))
+    if expected != actual:
+        return ['{}: {} files instead of {}'.format(actual_dir, len(actual), len(expected))]
+    differing = []
+    for name in expected:
+        with open(os.path.join(expected_dir, name), 'rb') as e, open(os.path.join(actual_dir, name), 'rb') as a:
+            if e.read() != a.read():
+                differing.append('{}: differs from the previous implementation'.format(
+                    os.path.join(actual_dir, name)))
+    return differing
+
+
+def png_export(batch_size=1000, workers=None):
+    """ Reports images/sec of saveTrainImages with 1 worker and with workers (defaults to all CPUs)
+
+    Every export is compared byte for byte with the PNGs of the previous pixel by pixel saveImage.
+    Exits with 1 if any file differs.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    workdir = tempfile.mkdtemp()
+    mismatches = []
+    try:
+        frompath = make_synthetic_cifar(os.path.join(workdir, 'cifar'), batch_size=batch_size)
+        number_of_images = batch_size * process_cifar.NUMBER_OF_TRAINING_BATCHES
+        reference_path = os.path.join(workdir, 'reference')
+        start = timeit.default_timer()
+        _reference_export(reference_path, frompath)
+        interval = timeit.default_timer() - start
+        print('previous saveImage images/sec: {:.1f}'.format(number_of_images / interval))
+        for n in sorted({1, workers}):
+            topath = os.path.join(workdir, 'train_{}'.format(n))
+            start = timeit.default_timer()
+            process_cifar.saveTrainImages(topath,
+                                          map_filename=os.path.join(workdir, 'train_map.txt'),
+                                          mean_filename=os.path.join(workdir, 'mean.xml'),
+                                          frompath=frompath,
+                                          workers=n)
+            interval = timeit.default_timer() - start
+            print('workers: {} images/sec: {:.1f}'.format(n, number_of_images / interval))
+            mismatches.extend(_differing_files(reference_path, topath))
+    finally:
+        shutil.rmtree(workdir)
+    for mismatch in mismatches:
+        print('FAILED', mismatch)
+    if mismatches:
+        sys.exit(1)
+    print('PNGs match the previous implementation')
+
+
+def _measure(function):
+    tracemalloc.start()
+    start = timeit.default_timer()
+    try:
+        function()
+        return timeit.default_timer() - start, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def shuffle_epoch(n=50000, batchsize=64, epochs=3):
+    """ Compares time and peak memory of a shuffled epoch with shuffle_data copies and with yield_mb
+    """
+    X = np.random.RandomState(0).randint(0, 256, size=(n, 3, 32, 32)).astype(np.float32)
+    y = np.arange(n, dtype=np.int32)
+
+    def copy_epoch():
+        X_shuffled, y_shuffled = utils.shuffle_data(X, y)
+        for i in range(n // batchsize):
+            X_shuffled[i * batchsize:(i + 1) * batchsize], y_shuffled[i * batchsize:(i + 1) * batchsize]
+
+    def gather_epoch():
+        for _ in utils.yield_mb(X, y, batchsize, shuffle=True):
+            pass
+
+    for name, epoch in (('shuffle_data copy', copy_epoch), ('yield_mb gather', gather_epoch)):
+        results = [_measure(epoch) for _ in range(epochs)]
+        print('{}: {:.3f} sec/epoch, peak {:.1f} MB'.format(name,
+                                                            min(interval for interval, _ in results),
+                                                            max(peak for _, peak in results) / 2.0 ** 20))
+
+
+def _reference_cifar_for_library(datapath, channel_first=True, one_hot=False):
+    # cifar_for_library as it was before the NumPy only preprocessing, scikit-learn's one-hot included
+    from sklearn.preprocessing import OneHotEncoder
+    x_train, x_test, y_train, y_test = utils.process_cifar(datapath)
+    # Scale pixel intensity
+    x_train = x_train / 255.0
+    x_test = x_test / 255.0
+    # Reshape
+    x_train = x_train.reshape(-1, 3, 32, 32)
+    x_test = x_test.reshape(-1, 3, 32, 32)
+    # Channel last
+    if not channel_first:
+        x_train = np.swapaxes(x_train, 1, 3)
+        x_test = np.swapaxes(x_test, 1, 3)
+    # One-hot encode y
+    if one_hot:
+        y_train = np.expand_dims(y_train, axis=-1)
+        y_test = np.expand_dims(y_test, axis=-1)
+        enc = OneHotEncoder(categorical_features='all')
+        fit = enc.fit(y_train)
+        y_train = fit.transform(y_train).toarray()
+        y_test = fit.transform(y_test).toarray()
+    # dtypes
+    x_train = x_train.astype(np.float32)
+    x_test = x_test.astype(np.float32)
+    y_train = y_train.astype(np.int32)
+    y_test = y_test.astype(np.int32)
+    return x_train, x_test, y_train, y_test
+
+
+def _timed_load(function, datapath, channel_first, one_hot):
+    start = timeit.default_timer()
+    function(datapath, channel_first=channel_first, one_hot=one_hot)
+    return timeit.default_timer() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def preprocess(batch_size=10000):
+    """ Checks cifar_for_library against the previous implementation and reports wall time and peak RSS
+
+    Each load runs in a fresh process, before this one holds any data since the peak RSS carries
+    over to spawned processes. Exits with 1 if any output differs from the previous implementation
+    in dtype, shape or values. Needs scikit-learn, as pinned in environment.yml, for the reference.
+    """
+    workdir = tempfile.mkdtemp()
+    options = ((True, False), (True, True), (False, False), (False, True))
+    mismatches = []
+    try:
+        datapath = make_synthetic_cifar(os.path.join(workdir, 'cifar'), batch_size=batch_size)
+        pool = multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1)
+        try:
+            for channel_first, one_hot in options:
+                print('channel_first={} one_hot={}'.format(channel_first, one_hot))
+                for name, function in (('before', _reference_cifar_for_library), ('after', utils.cifar_for_library)):
+                    interval, peak = pool.apply(_timed_load, (function, datapath, channel_first, one_hot))
+                    print('  {}: {:.3f} sec, peak RSS {:.1f} MB'.format(name, interval, peak))
+        finally:
+            pool.close()
+            pool.join()
+        for channel_first, one_hot in options:
+            expected = _reference_cifar_for_library(datapath, channel_first, one_hot)
+            actual = utils.cifar_for_library(datapath, channel_first=channel_first, one_hot=one_hot,
+                                             cache_dir=None)
+            for name, a, e in zip(utils._CACHED_ARRAYS, actual, expected):
+                if a.dtype != e.dtype or a.shape != e.shape:
+                    mismatches.append('channel_first={} one_hot={} {}: {} {} instead of {} {}'.format(
+                        channel_first, one_hot, name, a.dtype, a.shape, e.dtype, e.shape))
+                elif not np.array_equal(a, e):
+                    mismatches.append('channel_first={} one_hot={} {}: values differ'.format(channel_first,
+                                                                                         one_hot, name))
+            contiguous = all(a.flags['C_CONTIGUOUS'] for a in actual)
+            print('channel_first={} one_hot={}: C-contiguous: {}'.format(channel_first, one_hot, contiguous))
+    finally:
+        shutil.rmtree(workdir)
+    for mismatch in mismatches:
+        print('FAILED', mismatch)
+    if mismatches:
+        sys.exit(1)
+    print('Output matches the previous implementation')
+
+
+PREPARE_DATA_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exec_src', 'prepare_data.sh')
+
+
+def _run_concurrently(commands, env):
+    start = timeit.default_timer()
+    processes = [subprocess.Popen(command, env=env, stdout=subprocess.PIPE) for command in commands]
+    for process in processes:
+        process.communicate()
+        if process.returncode != 0:
+            raise RuntimeError('{} exited with {}'.format(process.args, process.returncode))
+    return timeit.default_timer() - start
+
+
+def staging(jobs=(1, 4, 9), batch_size=10000):
+    """ Reports the startup time of 1, 4 and 9 concurrent jobs on one node
+
+    Compares every job untarring the archive into the share with prepare_data.sh staging it once
+    in a node local cache. A local directory stands in for the file share. The jobs are processes
+    sharing one cache directory, which is what job containers see when the cache is in a host
+    directory mounted into all of them (AZ_BATCH_NODE_SHARED_DIR on Batch AI, temp/cache in local_test).
+    """
+    workdir = tempfile.mkdtemp()
+    try:
+        share = os.path.join(workdir, 'share')
+        make_synthetic_cifar(os.path.join(workdir, 'cifar-10-batches-py'), batch_size=batch_size)
+        os.makedirs(share)
+        archive = os.path.join(share, 'cifar-10-python.tar.gz')
+        with tarfile.open(archive, 'w:gz') as tar:
+            tar.add(os.path.join(workdir, 'cifar-10-batches-py'), arcname='cifar-10-batches-py')
+        with open(archive, 'rb') as f, open(archive + '.sha256', 'w') as checksum:
+            checksum.write('{}  cifar-10-python.tar.gz\n'.format(hashlib.sha256(f.read()).hexdigest()))
+        env = dict(os.environ, AZ_BATCHAI_INPUT_DATASET=share)
+        for n in jobs:
+            untar = _run_concurrently([['tar', 'xzf', archive, '--directory', share]] * n, env)
+            env['DATASET_LOCAL_CACHE'] = os.path.join(workdir, 'cache_{}'.format(n))
+            cold = _run_concurrently([['bash', PREPARE_DATA_SCRIPT]] * n, env)
+            warm = _run_concurrently([['bash', PREPARE_DATA_SCRIPT]] * n, env)
+            print('jobs: {} untar on share: {:.3f} sec, staged cold: {:.3f} sec, staged warm: {:.3f} sec'.format(
+                n, untar, cold, warm))
+    finally:
+        shutil.rmtree(workdir)
+
+
+def _export_stage(datapath, workdir, workers):
+    def run():
+        process_cifar.export(os.path.join(workdir, 'export'), frompath=datapath, workers=workers)
+    return run, 6 * _batch_length(datapath)
+
+
+def _save_train_images_stage(datapath, workdir, workers):
+    def run():
+        process_cifar.saveTrainImages(os.path.join(workdir, 'train'),
+                                      map_filename=os.path.join(workdir, 'train_map.txt'),
+                                      mean_filename=os.path.join(workdir, 'mean.xml'),
+                                      frompath=datapath,
+                                      workers=workers)
+    return run, process_cifar.NUMBER_OF_TRAINING_BATCHES * _batch_length(datapath)
+
+
+def _process_cifar_stage(datapath, workdir, workers):
+    return lambda: utils.process_cifar(datapath), 6 * _batch_length(datapath)
+
+
+def _cifar_for_library_stage(datapath, workdir, workers):
+    return lambda: utils.cifar_for_library(datapath, cache_dir=None), 6 * _batch_length(datapath)
+
+
+def _yield_mb_stage(datapath, workdir, workers):
+    x_train, _, y_train, _ = utils.cifar_for_library(datapath, cache_dir=None)
+
+    def run():
+        for _ in utils.yield_mb(x_train, y_train, 64, shuffle=True):
+            pass
+    return run, len(x_train)
+
+
+def _batch_length(datapath):
+    return len(process_cifar.load_batch(os.path.join(datapath, 'test_batch'))[0])
+
+
+# Stages of the suite, each returns the function to time and the number of images it goes through
+SUITE_STAGES = (('process_cifar.export', _export_stage),
+                ('process_cifar.saveTrainImages', _save_train_images_stage),
+                ('utils.process_cifar', _process_cifar_stage),
+                ('utils.cifar_for_library', _cifar_for_library_stage),
+                ('utils.yield_mb', _yield_mb_stage))
+
+
+def _run_stage(stage, datapath, workers):
+    workdir = tempfile.mkdtemp()
+    try:
+        run, number_of_images = stage(datapath, workdir, workers)
+        start = timeit.default_timer()
+        run()
+        interval = timeit.default_timer() - start
+    finally:
+        shutil.rmtree(workdir)
+    # Pool workers of the PNG export are children of this process
+    peak = max(resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+    return {'wall_sec': interval,
+            'images_per_sec': number_of_images / interval,
+            'peak_rss_mb': peak / 1024.0}
+
+
+def _regressions(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for metric in ('wall_sec', 'peak_rss_mb'):
+            if result[metric] > baseline[name][metric] * (1 + tolerance):
+                regressions.append('{} {}: {:.3f} against baseline {:.3f}'.format(
+                    name, metric, result[metric], baseline[name][metric]))
+    return regressions
+
+
+def suite(batch_size=2000, repeat=3, workers=1, output='benchmark_results.json',
+          baseline='benchmark_baseline.json', tolerance=0.2, update_baseline=False):
+    """ Times the data pipeline stages on synthetic batches and checks them against a stored baseline
+
+    Each run of a stage is in a fresh process so its peak RSS is its own, the fastest of repeat runs
+    and the largest peak are kept. Results are saved to output, a stage is flagged when its wall time
+    or peak RSS is more than tolerance above the baseline and the exit status is then 1.
+    Pass update_baseline=True to store the results as the new baseline.
+    """
+    workdir = tempfile.mkdtemp()
+    try:
+        datapath = make_synthetic_cifar(os.path.join(workdir, 'cifar'), batch_size=batch_size)
+        pool = multiprocessing.get_context('spawn').Pool(1, maxtasksperchild=1)
+        results = {}
+        try:
+            for name, stage in SUITE_STAGES:
+                runs = [pool.apply(_run_stage, (stage, datapath, workers)) for _ in range(repeat)]
+                fastest = min(runs, key=lambda run: run['wall_sec'])
+                results[name] = dict(fastest, peak_rss_mb=max(run['peak_rss_mb'] for run in runs))
+                print('{:<30} {:>9.3f} sec {:>12.1f} images/sec {:>9.1f} MB peak RSS'.format(
+                    name, results[name]['wall_sec'], results[name]['images_per_sec'], results[name]['peak_rss_mb']))
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(workdir)
+
+    report = {'batch_size': batch_size, 'repeat': repeat, 'workers': workers, 'stages': results}
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    if update_baseline:
+        with open(baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('Baseline saved to {}'.format(baseline))
+        return
+    if not os.path.exists(baseline):
+        print('No baseline at {}, run with --update_baseline to store one'.format(baseline))
+        return
+    with open(baseline) as f:
+        stored = json.load(f)
+    if stored['batch_size'] != batch_size or stored['workers'] != workers:
+        print('Baseline was run with batch_size={} workers={}, not comparing'.format(stored['batch_size'],
+                                                                                     stored['workers']))
+        return
+    regressions = _regressions(results, stored['stages'], tolerance)
+    for regression in regressions:
+        print('REGRESSION ' + regression)
+    if regressions:
+        sys.exit(1)
+    print('No regressions against {}'.format(baseline))
+
+
+def _list_files(directory):
+    return [os.stat(os.path.join(root, name)).st_size
+            for root, _, names in os.walk(directory) for name in names]
+
+
+def _read_loose(data_dir):
+    with open(os.path.join(data_dir, 'train_map.txt')) as f:
+        names = [line.split('\t')[0] for line in f]
+    for index in np.random.RandomState(0).permutation(len(names)):
+        with open(os.path.join(data_dir, 'train', names[index]), 'rb') as f:
+            f.read()
+
+
+def _read_packed(data_dir):
+    with process_cifar.ShardedDataset(data_dir, 'train') as dataset:
+        for index in np.random.RandomState(0).permutation(len(dataset)):
+            dataset.read_bytes(index)
+
+
+def packed_dataset(batch_size=2000):
+    """ Compares listing, copying (the upload) and reading in random order the PNG and packed layouts
+
+    Both are on the local disk here, on the file share each loose file adds its own round trips.
+    """
+    workdir = tempfile.mkdtemp()
+    try:
+        frompath = make_synthetic_cifar(os.path.join(workdir, 'cifar'), batch_size=batch_size)
+        for name, packed, read in (('png', False, _read_loose), ('packed', True, _read_packed)):
+            data_dir = os.path.join(workdir, name)
+            process_cifar.export(data_dir, frompath=frompath, workers=1, packed=packed)
+            timings = []
+            for step in (lambda: _list_files(data_dir),
+                         lambda: shutil.copytree(data_dir, data_dir + '_copy'),
+                         lambda: read(data_dir)):
+                start = timeit.default_timer()
+                step()
+                timings.append(timeit.default_timer() - start)
+            print('{:<7} files: {:>6} list: {:.4f} sec copy: {:.4f} sec read: {:.4f} sec'.format(
+                name, len(_list_files(data_dir)), *timings))
+    finally:
+        shutil.rmtree(workdir)
+
+
+def profiler_overhead(sections=100000):
+    """ Reports the time a Profiler section adds around an empty block
+    """
+    profiler = utils.Profiler()
+    start = timeit.default_timer()
+    for _ in range(sections):
+        with profiler.section('epoch'):
+            pass
+    interval = timeit.default_timer() - start
+    print('{:.2f} usec per section'.format(1e6 * interval / sections))
+
+
+def _orchestration_steps(setup_bait, workspace, experiment, polling_interval):
+    import utilities as ut
+    config = setup_bait.config
+    job_names = [job[0] for job in setup_bait.FRAMEWORK_JOBS]
+    return (('create workspace and experiment', lambda: (setup_bait.create_workspace(workspace),
+                                                         setup_bait.create_experiment(workspace, experiment))),
+            ('setup and wait for cluster', lambda: (setup_bait.setup_cluster(workspace),
+                                                    ut.wait_for_cluster(config, config.group_name, workspace,
+                                                                        config.cluster_name,
+                                                                        polling_interval=polling_interval))),
+            ('submit_all', lambda: setup_bait.submit_all(workspace, experiment)),
+            ('wait for jobs', lambda: ut.monitor_jobs(setup_bait.client, config.group_name, workspace, experiment,
+                                                      job_names, config.cluster_name,
+                                                      polling_interval=polling_interval,
+                                                      max_polling_interval=8 * polling_interval)),
+            ('harvest_results', lambda: setup_bait.harvest_results(workspace, experiment, job_names,
+                                                                   csv_filename=None, json_filename=None)),
+            ('delete_all_jobs', lambda: setup_bait.delete_all_jobs(workspace, experiment)))
+
+
+def autoscale(node_count=10, allocation_sec=2.0, allocation_spread_sec=2.0, job_sec=2.0, scale_down_sec=1.0,
+              linger_sec=5.0, polling_interval=0.1):
+    """ Compares the time to the first job and the idle node time of a fixed and an auto-scaled cluster
+
+    Runs the framework jobs on a fake cluster, waiting for all the nodes or only for the first, and
+    counts the node time until linger_sec after the jobs finished, when the cluster would be deleted.
+    """
+    import fake_batchai
+    import utilities as ut
+    for name in ('TENANT', 'GROUP_NAME', 'FILE_SHARE_NAME'):
+        os.environ.setdefault(name, 'fake')
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import setup_bait
+    config = setup_bait.current_config()
+    job_names = [job[0] for job in setup_bait.FRAMEWORK_JOBS]
+    runs = (('manual, wait for all nodes', None, None),
+            ('manual, wait for first node', None, 1),
+            ('auto 0-{}'.format(node_count), node_count, 1))
+    for name, max_node_count, min_ready_nodes in runs:
+        backend = fake_batchai.FakeBackend(allocation_sec=allocation_sec, allocation_spread_sec=allocation_spread_sec,
+                                           job_sec=job_sec, scale_down_sec=scale_down_sec)
+        config.update(node_count=node_count, min_node_count=0, max_node_count=max_node_count)
+        with fake_batchai.installed(backend), open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            start = time.time()
+            setup_bait.setup_cluster('workspace')
+            ut.wait_for_cluster(config, config.group_name, 'workspace', config.cluster_name,
+                                polling_interval=polling_interval, min_ready_nodes=min_ready_nodes)
+            ready_sec = time.time() - start
+            setup_bait.submit_all('workspace', 'experiment')
+            ut.monitor_jobs(setup_bait.client, config.group_name, 'workspace', 'experiment', job_names,
+                            config.cluster_name, polling_interval=polling_interval,
+                            max_polling_interval=polling_interval)
+            makespan = time.time() - start
+            time.sleep(linger_sec)
+            usage = backend.node_usage('workspace', config.cluster_name)
+        first_job_sec = min(job.started for job in backend.jobs.values()) - start
+        print('{:<28} ready {:5.2f} sec, first job {:5.2f} sec, makespan {:5.2f} sec, '
+              'node time {:6.1f} sec of which idle {:6.1f} sec'.format(name, ready_sec, first_job_sec, makespan,
+                                                                      usage['node_sec'], usage['idle_node_sec']))
+    config.update(min_node_count=None, max_node_count=None)
+
+
+def _submit_all_and_wait(setup_bait, workspace, experiment, polling_interval):
+    import utilities as ut
+    config = setup_bait.config
+    start = time.time()
+    setup_bait.submit_all(workspace, experiment)
+    jobs = ut.monitor_jobs(setup_bait.client, config.group_name, workspace, experiment,
+                           [job[0] for job in setup_bait.FRAMEWORK_JOBS], config.cluster_name,
+                           polling_interval=polling_interval, max_polling_interval=8 * polling_interval)
+    makespan = time.time() - start
+    busy = sum(job['running_sec'] or 0 for job in jobs.values())
+    return {'jobs': jobs, 'makespan_sec': makespan, 'utilization': busy / (config.node_count * makespan)}
+
+
+def job_queue(node_count=3, job_sec=2.0, latency=0.02, polling_interval=0.1, seed=0):
+    """ Compares submit_all followed by monitor_jobs with run_queue on a fake cluster of node_count nodes
+
+    The jobs run between 0.5 and 1.5 times job_sec.
+    """
+    import fake_batchai
+    for name in ('TENANT', 'GROUP_NAME', 'FILE_SHARE_NAME'):
+        os.environ.setdefault(name, 'fake')
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import setup_bait
+    setup_bait.current_config().update(node_count=node_count)
+    rng = np.random.RandomState(seed)
+    durations = dict((job[0], job_sec * rng.uniform(0.5, 1.5)) for job in setup_bait.FRAMEWORK_JOBS)
+    runs = (('submit_all + monitor_jobs', lambda: _submit_all_and_wait(setup_bait, 'workspace', 'experiment',
+                                                                      polling_interval)),
+            ('run_queue', lambda: setup_bait.run_queue('workspace', 'experiment', polling_interval=polling_interval,
+                                                       max_polling_interval=8 * polling_interval)))
+    for name, run in runs:
+        backend = fake_batchai.FakeBackend(allocation_sec=0, job_durations=durations, latency=latency)
+        with fake_batchai.installed(backend), open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            setup_bait.setup_cluster('workspace')
+            stats = fake_batchai.measure(backend, run)
+        queued = [job['queued_sec'] for job in stats['result']['jobs'].values()]
+        print('{:<26} makespan {:.2f} sec, utilization {:.0%}, queued {:.2f}-{:.2f} sec, {} calls'.format(
+            name, stats['result']['makespan_sec'], stats['result']['utilization'], min(queued), max(queued),
+            stats['total_calls']))
+
+
+def _previous_jobs_list_for(client, workspace, experiment, resource_group=None):
+    # jobs_list_for before the listing was paged through lazily and cached
+    return [job.as_dict() for job in client.jobs.list_by_experiment(resource_group, workspace, experiment)]
+
+
+def job_listing(jobs=200, page_size=100, latency=0.05):
+    """ Reports the time and list calls of the job helpers on an experiment with many jobs
+
+    Runs print_jobs_summary, print_jobs_summary of the failed jobs, print_jobs and delete_all_jobs
+    as they would be run one after the other from the notebook, against fake_batchai.
+    """
+    import fake_batchai
+    import utilities as ut
+    for name in ('TENANT', 'GROUP_NAME', 'FILE_SHARE_NAME'):
+        os.environ.setdefault(name, 'fake')
+    import setup_bait
+    config = setup_bait.current_config()
+    ut.JOBS_PAGE_SIZE = page_size
+    backend = fake_batchai.FakeBackend(allocation_sec=0, job_sec=0, failing_jobs=['job_{}'.format(i) for i in range(0, jobs, 10)])
+    with fake_batchai.installed(backend), open(os.devnull, 'w') as devnull:
+        with redirect_stdout(devnull):
+            setup_bait.setup_cluster('workspace')
+            cluster_id = setup_bait.current_cluster('workspace').id
+            for i in range(jobs):
+                ut.create_job(config, cluster_id, 'workspace', 'experiment', 'job_{}'.format(i), 'image', 'command')
+        backend.latency = latency
+        client = setup_bait.client
+        stats = fake_batchai.measure(backend, lambda: [_previous_jobs_list_for(client, 'workspace', 'experiment', config.group_name)
+                                                       for _ in range(3)])
+        print('previous listing x3: {:.2f} sec, {} calls'.format(stats['wall_sec'], stats['total_calls']))
+        start = time.time()
+        next(ut.iter_jobs(client, 'workspace', 'experiment', resource_group=config.group_name))
+        print('first job from iter_jobs: {:.2f} sec'.format(time.time() - start))
+        ut.invalidate_jobs_cache(config.group_name, 'workspace', 'experiment')
+        steps = (('print_jobs_summary', lambda: setup_bait.print_jobs_summary('workspace', 'experiment')),
+                 ('print_jobs_summary failed', lambda: setup_bait.print_jobs_summary('workspace', 'experiment',
+                                                                                     states='failed')),
+                 ('print_jobs', lambda: setup_bait.print_jobs('workspace', 'experiment')),
+                 ('delete_all_jobs', lambda: setup_bait.delete_all_jobs('workspace', 'experiment')))
+        for name, step in steps:
+            with redirect_stdout(devnull):
+                stats = fake_batchai.measure(backend, step)
+            print('{:<26} {:.2f} sec, {} list calls'.format(name, stats['wall_sec'],
+                                                            stats['calls'].get('jobs.list_by_experiment', 0)))
+
+
+def _previous_delete_all_jobs_for(resource_group, workspace, experiment, client):
+    # delete_all_jobs_for before the deletes were made concurrently, returns the pollers it did not wait on
+    return [client.jobs.delete(resource_group, workspace, experiment, job.name)
+            for job in client.jobs.list_by_experiment(resource_group, workspace, experiment)]
+
+
+def _fake_experiment(setup_bait, jobs):
+    import utilities as ut
+    config = setup_bait.current_config()
+    setup_bait.create_workspace('workspace')
+    setup_bait.create_experiment('workspace', 'experiment')
+    setup_bait.setup_cluster('workspace')
+    cluster_id = setup_bait.current_cluster('workspace').id
+    for i in range(jobs):
+        ut.create_job(config, cluster_id, 'workspace', 'experiment', 'job_{}'.format(i), 'image', 'command')
+
+
+def teardown(jobs=100, latency=0.05, operation_sec=1.0, failure_rate=0.0):
+    """ Reports the time until all jobs, the cluster and the experiment are deleted, against fake_batchai
+
+    The previous sequential deletes are timed until the last of their operations is done.
+    failure_rate is the share of job deletes that fail.
+    """
+    import fake_batchai
+    for name in ('TENANT', 'GROUP_NAME', 'FILE_SHARE_NAME'):
+        os.environ.setdefault(name, 'fake')
+    import setup_bait
+    group_name = setup_bait.current_config().group_name
+
+    def previous():
+        pollers = _previous_delete_all_jobs_for(group_name, 'workspace', 'experiment', setup_bait.client)
+        for poller in pollers:
+            poller.result()
+        setup_bait.delete_cluster('workspace').result()
+        setup_bait.delete_experiment('workspace', 'experiment')
+
+    def current():
+        errors = setup_bait.teardown('workspace', 'experiment')
+        failed = [key for key, error in errors.items() if error is not None]
+        print('{} of {} deletions failed'.format(len(failed), len(errors)))
+
+    for name, fn in (('sequential', previous), ('teardown', current)):
+        backend = fake_batchai.FakeBackend(allocation_sec=0, job_sec=0, operation_sec=0)
+        with fake_batchai.installed(backend):
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                _fake_experiment(setup_bait, jobs)
+            backend.latency = latency
+            backend.operation_sec = operation_sec
+            if name == 'teardown':
+                backend.failures = {'jobs.delete': failure_rate}
+            stats = fake_batchai.measure(backend, fn)
+            print('{:<10} {:.2f} sec, {} calls, jobs left {}'.format(name, stats['wall_sec'], stats['total_calls'],
+                                                                     len(backend.jobs)))
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    # Serves server.data with Range support, the first server.drops GETs stop halfway through the range
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.server.data)))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        data = self.server.data
+        start, end = 0, len(data) - 1
+        if 'Range' in self.headers:
+            start, end = (int(value) for value in self.headers['Range'].split('=')[1].split('-'))
+        body = data[start:end + 1]
+        self.send_response(206 if 'Range' in self.headers else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))
+        self.end_headers()
+        with self.server.lock:
+            drop = self.server.drops > 0
+            self.server.drops -= drop
+        if drop:
+            body = body[:len(body) // 2]
+            self.close_connection = True
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.served += len(body)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer only exists from Python 3.7, environment.yml pins 3.6
+    daemon_threads = True
+
+
+def _range_server(data):
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), _RangeHandler)
+    server.data = data
+    server.drops = 0
+    server.served = 0
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def resumable_download(size_mb=32, part_mb=4, drops=3, workers=4):
+    """ Checks that an interrupted ranged download resumes, against a local server that drops connections
+
+    The first attempt has drops parts cut off halfway and fails, the second must finish the file
+    re-fetching only what is missing. It is repeated with the progress sidecar truncated as if the
+    process died while writing it, which must start over instead of failing. Exits with 1 if the
+    downloaded file differs or a resume does not complete.
+    """
+    import utilities as ut
+    data = os.urandom(int(size_mb * 1024 * 1024))
+    server = _range_server(data)
+    url = 'http://127.0.0.1:{}/file'.format(server.server_address[1])
+    part_size = int(part_mb * 1024 * 1024)
+    session = ut.session_factory()
+    failures = []
+    workdir = tempfile.mkdtemp()
+    try:
+        for truncate_sidecar in (False, True):
+            destination = os.path.join(workdir, 'sidecar_truncated' if truncate_sidecar else 'resumed')
+            sidecar = destination + '.partial.json'
+            server.drops, server.served = drops, 0
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                try:
+                    ut.download_file(url, destination, session=session, part_size=part_size, max_workers=workers)
+                    failures.append('{}: the first attempt did not fail'.format(destination))
+                except Exception:
+                    pass
+                first = server.served
+                if truncate_sidecar:
+                    with open(sidecar, 'r+') as f:
+                        f.truncate(os.path.getsize(sidecar) // 2)
+                server.served = 0
+                start = time.time()
+                try:
+                    ut.download_file(url, destination, session=session, part_size=part_size, max_workers=workers)
+                except Exception as e:
+                    failures.append('{}: resume failed with {!r}'.format(destination, e))
+                    continue
+            elapsed = time.time() - start
+            with open(destination, 'rb') as f:
+                if f.read() != data:
+                    failures.append('{}: content differs'.format(destination))
+            print('{:<30} first attempt {:.1f} MB, resume {:.1f} MB in {:.2f} sec'.format(
+                'truncated sidecar' if truncate_sidecar else 'dropped connections', first / 2 ** 20,
+                server.served / 2 ** 20, elapsed))
+            if not truncate_sidecar and server.served >= len(data):
+                failures.append('{}: resume downloaded the whole file again'.format(destination))
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+    for failure in failures:
+        print('FAILED', failure)
+    if failures:
+        sys.exit(1)
+
+
+class _InfluxHandler(BaseHTTPRequestHandler):
+    # Accepts InfluxDB writes and counts their points, answers server.reject_request with an error
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.server.lock:
+            self.server.requests += 1
+            rejected = self.server.requests == self.server.reject_request
+            if not rejected:
+                self.server.points += len([line for line in body.splitlines() if line.strip()])
+        self.send_response(500 if rejected else 204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def influx_writer(points=1000, batch_size=100, reject_batch=3):
+    """ Checks create_logger's asynchronous writes against a local stand-in for the InfluxDB server
+
+    The server rejects the reject_batch-th batch. After flush the writer must count that batch in
+    failed and the other points in written, all received by the server, with nothing dropped.
+    Writing after close must be counted in dropped and flush must then return False at once.
+    Exits with 1 on any mismatch. Needs the influxdb client the docker images install.
+    """
+    from influxdb import InfluxDBClient
+    server = _ThreadingHTTPServer(('127.0.0.1', 0), _InfluxHandler)
+    server.requests = 0
+    server.points = 0
+    server.reject_request = reject_batch
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    failures = []
+    try:
+        client = InfluxDBClient('127.0.0.1', server.server_address[1], 'user', 'password', 'db')
+        # A long flush interval so only batch_size decides the batches
+        writer = utils.AsyncInfluxWriter(client, batch_size=batch_size, flush_interval=60)
+        logger = utils.create_logger(writer, node_id='node', job_id='job')
+        start = time.time()
+        for i in range(points):
+            logger('loss', value=float(i))
+        logged = time.time() - start
+        if not writer.flush(timeout=30):
+            failures.append('flush timed out')
+        print('logged {} points in {:.3f} sec, written {}, failed {}, dropped {}, received {}'.format(
+            points, logged, writer.written, writer.failed, writer.dropped, server.points))
+        expected = {'written': points - batch_size, 'failed': batch_size, 'dropped': 0,
+                    'received': points - batch_size, 'logger failed': 0}
+        actual = {'written': writer.written, 'failed': writer.failed, 'dropped': writer.dropped,
+                  'received': server.points, 'logger failed': logger.failed}
+        failures.extend('{}: {} instead of {}'.format(name, actual[name], value)
+                        for name, value in expected.items() if actual[name] != value)
+        writer.close()
+        logger('loss', value=0.0)
+        if writer.dropped != 1:
+            failures.append('a point logged after close counted as {} dropped'.format(writer.dropped))
+        start = time.time()
+        if writer.flush() or time.time() - start > 1:
+            failures.append('flush after close did not return False at once')
+    finally:
+        server.shutdown()
+    for failure in failures:
+        print('FAILED', failure)
+    if failures:
+        sys.exit(1)
+
+
+def orchestration(node_count=2, allocation_sec=1.0, job_sec=2.0, latency=0.05, polling_interval=0.25,
+                  verbose=False):
+    """ Reports the wall time and Batch AI and storage calls of each step from creating the cluster
+    to harvesting the results and deleting the jobs, run against fake_batchai with latency seconds per call
+    """
+    import fake_batchai
+    for name in ('TENANT', 'GROUP_NAME', 'FILE_SHARE_NAME'):
+        os.environ.setdefault(name, 'fake')
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    import setup_bait
+    setup_bait.current_config().update(node_count=node_count)
+    backend = fake_batchai.FakeBackend(allocation_sec=allocation_sec, job_sec=job_sec, latency=latency)
+    with fake_batchai.installed(backend), open(os.devnull, 'w') as devnull:
+        for name, step in _orchestration_steps(setup_bait, 'workspace', 'experiment', polling_interval):
+            with redirect_stdout(sys.stdout if verbose else devnull):
+                stats = fake_batchai.measure(backend, step)
+            print('{:<32} {:>7.2f} sec {:>5} calls  {}'.format(
+                name, stats['wall_sec'], stats['total_calls'],
+                ', '.join('{}={}'.format(call, count) for call, count in sorted(stats['calls'].items()))))
+
+
+class _StubCredentials(object):
+    """ Stands in for ServicePrincipalCredentials, sleeping to mimic the token request
+    """
+    token_latency = 0.5
+
+    def __init__(self, client_id=None, secret=None, tenant=None):
+        time.sleep(self.token_latency)
+        self.token = {'expires_on': time.time() + 3600}
+
+
+def setup_import(token_latency=0.5):
+    """ Reports the time to import setup_bait and to get the Batch AI client the first and second time
+
+    Credentials are stubbed, each token request takes token_latency seconds.
+    """
+    import utilities as ut
+    for name in ('TENANT', 'GROUP_NAME', 'FILE_SHARE_NAME'):
+        os.environ.setdefault(name, 'fake')
+    _StubCredentials.token_latency = token_latency
+    ut.credentials_factory = _StubCredentials
+    sys.modules.pop('setup_bait', None)
+
+    start = timeit.default_timer()
+    import setup_bait
+    print('import setup_bait: {:.3f} sec'.format(timeit.default_timer() - start))
+    for call in ('first', 'second'):
+        start = timeit.default_timer()
+        setup_bait.current_client()
+        print('{} current_client(): {:.3f} sec'.format(call, timeit.default_timer() - start))
+
+
+if __name__ == '__main__':
+    fire.Fire({'autoscale': autoscale,
+               'influx_writer': influx_writer,
+               'job_listing': job_listing,
+               'job_queue': job_queue,
+               'orchestration': orchestration,
+               'packed_dataset': packed_dataset,
+               'png_export': png_export,
+               'profiler_overhead': profiler_overhead,
+               'resumable_download': resumable_download,
+               'setup_import': setup_import,
+               'shuffle_epoch': shuffle_epoch,
+               'staging': staging,
+               'suite': suite,
+               'teardown': teardown,
+               'preprocess': preprocess})
@@ -1,3 +1,47 @@
 #!/usr/bin/env bash
+# Stages the CIFAR archive from $AZ_BATCHAI_INPUT_DATASET (the file share) into a node local cache
+# and extracts it there once. Jobs on the same node take a lock and reuse the extraction when its
+# checksum matches the archive. Prints the local dataset directory to use as AZ_BATCHAI_INPUT_DATASET.
+#
+# The cache is DATASET_LOCAL_CACHE, by default dataset_cache in AZ_BATCH_NODE_SHARED_DIR, a directory
+# on the node's disk that Batch mounts into every job container. It has to be mounted like that for
+# jobs to share it, a container's own /tmp is private to it and would be staged again by every job.
+set -euo pipefail
 
-tar xzvf $AZ_BATCHAI_INPUT_DATASET/cifar-10-python.tar.gz --directory $AZ_BATCHAI_INPUT_DATASET
+ARCHIVE_NAME=cifar-10-python.tar.gz
+ARCHIVE=$AZ_BATCHAI_INPUT_DATASET/$ARCHIVE_NAME
+CACHE_DIR=${DATASET_LOCAL_CACHE:-${AZ_BATCH_NODE_SHARED_DIR:-/tmp}/dataset_cache}
+
+mkdir -p "$CACHE_DIR"
+exec 9>"$CACHE_DIR/.lock"
+flock 9
+
+# The checksum is written next to the archive by make prepare-data. Shares set up without it are
+# matched by the archive's size and modification time, and the staged copy is hashed once instead
+stamp=$(stat -c '%s %Y' "$ARCHIVE")
+expected=
+if [ -f "$ARCHIVE.sha256" ]; then
+    expected=$(cut -d' ' -f1 "$ARCHIVE.sha256")
+    [ "$(cat "$CACHE_DIR/.complete" 2>/dev/null)" == "$expected" ] && stale=0 || stale=1
+else
+    [ -f "$CACHE_DIR/.complete" ] && [ "$(cat "$CACHE_DIR/.source" 2>/dev/null)" == "$stamp" ] && stale=0 || stale=1
+fi
+
+if [ "$stale" == 1 ]; then
+    echo "Staging $ARCHIVE in $CACHE_DIR" >&2
+    rm -f "$CACHE_DIR/.complete" "$CACHE_DIR/.source"
+    rm -rf "$CACHE_DIR/staging" && mkdir "$CACHE_DIR/staging"
+    cp "$ARCHIVE" "$CACHE_DIR/staging/$ARCHIVE_NAME"
+    actual=$(sha256sum "$CACHE_DIR/staging/$ARCHIVE_NAME" | cut -d' ' -f1)
+    if [ -n "$expected" ] && [ "$actual" != "$expected" ]; then
+        echo "Checksum mismatch for $ARCHIVE: expected $expected got $actual" >&2
+        exit 1
+    fi
+    tar xzf "$CACHE_DIR/staging/$ARCHIVE_NAME" --directory "$CACHE_DIR/staging"
+    rm "$CACHE_DIR/staging/$ARCHIVE_NAME"
+    rm -rf "$CACHE_DIR/data" && mv "$CACHE_DIR/staging" "$CACHE_DIR/data"
+    echo "$stamp" > "$CACHE_DIR/.source"
+    echo "$actual" > "$CACHE_DIR/.complete"
+fi
+
+echo "$CACHE_DIR/data"
@@ -0,0 +1,17 @@
+#!/usr/bin/env bash
+# Runs a notebook in a job: stages the dataset with prepare_data.sh, points AZ_BATCHAI_INPUT_DATASET
+# at the staged copy and executes the notebook with papermill from the scripts directory.
+# Usage: run_notebook.sh <input notebook> <output notebook> [papermill options, e.g. -p EPOCHS 5]
+set -euo pipefail
+
+SCRIPT_DIR=$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)
+# cifar_for_library caches its arrays next to the staged dataset only in the node directory the job
+# containers share, a cache private to one container costs more to write than it saves
+if [ -z "${DATASET_CACHE_DIR:-}" ] && [ -n "${AZ_BATCH_NODE_SHARED_DIR:-}" ]; then
+    export DATASET_CACHE_DIR=$AZ_BATCH_NODE_SHARED_DIR/dataset_cache/arrays
+fi
+# Assigned on its own so a failed staging stops the job, export would hide the exit status
+AZ_BATCHAI_INPUT_DATASET=$(bash "$SCRIPT_DIR/prepare_data.sh")
+export AZ_BATCHAI_INPUT_DATASET
+cd "$SCRIPT_DIR"
+papermill "$@" --log-output --no-progress-bar
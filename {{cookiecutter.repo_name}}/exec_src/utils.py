@@ -1,11 +1,36 @@
+import atexit
+import fcntl
+import json
+import os
 import pickle
+import shutil
 import sys
+import tempfile
+import threading
 import timeit
+from contextlib import contextmanager
 from datetime import datetime
 from os import path
 
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
 import numpy as np
-from sklearn.preprocessing import OneHotEncoder
+
+NUMBER_OF_TRAINING_BATCHES = 5
+# If set and not empty, cifar_for_library keeps a memory-mapped copy of its output here
+CACHE_DIR = os.getenv('DATASET_CACHE_DIR') or None
+_CACHE_VERSION = 1
+_CIFAR_FILES = ['data_batch_{}'.format(i + 1) for i in range(NUMBER_OF_TRAINING_BATCHES)] + ['test_batch']
+_CACHED_ARRAYS = ('x_train', 'x_test', 'y_train', 'y_test')
+MAX_PIXEL_VALUE = 255.0
+_SCALE_BLOCK_ROWS = 1024
+# Rank and world size variables Shard.from_env looks for, in order
+SHARD_ENV_VARS = (('RANK', 'WORLD_SIZE'),
+                  ('OMPI_COMM_WORLD_RANK', 'OMPI_COMM_WORLD_SIZE'),
+                  ('PMI_RANK', 'PMI_SIZE'))
 
 
 def read_batch(src):
@@ -19,30 +44,215 @@ def read_batch(src):
     return data
 
 
-def shuffle_data(X, y):
-    s = np.arange(len(X))
-    np.random.shuffle(s)
+def _random_state(rng):
+    if rng is None:
+        return np.random
+    if isinstance(rng, np.random.RandomState):
+        return rng
+    return np.random.RandomState(rng)
+
+
+def shuffled_order(n, rng=None):
+    '''Returns a random permutation of range(n)
+
+    rng can be a seed or a np.random.RandomState, by default the global numpy generator is used.
+    '''
+    s = np.arange(n)
+    _random_state(rng).shuffle(s)
+    return s
+
+
+def shuffle_data(X, y, rng=None):
+    s = shuffled_order(len(X), rng)
     X = X[s]
     y = y[s]
     return X, y
 
 
-def yield_mb(X, y, batchsize=64, shuffle=False):
+def _minibatches(X, y, batchsize, shuffle, normalize, dtype, buffers, order=None, rng=None):
     assert len(X) == len(y)
-    if shuffle:
-        X, y = shuffle_data(X, y)
+    if order is None and shuffle:
+        order = shuffled_order(len(X), rng)
     # Only complete batches are submitted
-    for i in range(len(X) // batchsize):
-        yield X[i * batchsize:(i + 1) * batchsize], y[i * batchsize:(i + 1) * batchsize]
+    number_of_batches = (len(X) if order is None else len(order)) // batchsize
+    if order is None and normalize is None:
+        for i in range(number_of_batches):
+            yield X[i * batchsize:(i + 1) * batchsize], y[i * batchsize:(i + 1) * batchsize]
+        return
+
+    # Rows are gathered straight into preallocated buffers instead of shuffling a copy of X
+    shape = (batchsize,) + X.shape[1:]
+    ring = np.empty((buffers,) + shape, dtype=X.dtype if normalize is None else dtype)
+    gathered = np.empty(shape, dtype=X.dtype) if normalize is not None and order is not None else None
+    for i in range(number_of_batches):
+        out = ring[i % buffers]
+        if order is None:
+            rows = X[i * batchsize:(i + 1) * batchsize]
+            labels = y[i * batchsize:(i + 1) * batchsize]
+        else:
+            index = order[i * batchsize:(i + 1) * batchsize]
+            # mode='clip' lets take write into out directly, the indices are always in range
+            rows = np.take(X, index, axis=0, out=out if gathered is None else gathered, mode='clip')
+            labels = y[index]
+        if normalize is not None:
+            np.divide(rows, normalize, out=out, dtype=dtype)
+        yield out, labels
+
+
+def yield_mb(X, y, batchsize=64, shuffle=False, normalize=None, dtype=np.float32, order=None, rng=None):
+    '''Yield minibatches of X and y
+
+    Shuffling only permutes an index array, drawn from rng (see shuffled_order), and each
+    minibatch is gathered into a preallocated buffer. If order is given the rows are visited in
+    that order instead, e.g. Shard.epoch_order. If normalize is given, X is expected to hold raw
+    pixels (see cifar_for_library(lazy=True)) and each minibatch is divided by normalize and cast
+    to dtype. Buffers are reused, so when shuffling or normalizing a yielded batch is only valid
+    until the next one is requested.
+    '''
+    return _minibatches(X, y, batchsize, shuffle, normalize, dtype, buffers=1, order=order, rng=rng)
+
+
+def prefetch_mb(X, y, batchsize=64, shuffle=False, normalize=None, dtype=np.float32, depth=2, order=None,
+                rng=None):
+    '''Same as yield_mb but prepares the next depth minibatches on a background thread
+
+    The returned Prefetcher records in wait_time how long the training loop waited for data.
+    '''
+    return Prefetcher(_minibatches(X, y, batchsize, shuffle, normalize, dtype, buffers=depth + 2, order=order,
+                                   rng=rng),
+                      depth=depth)
+
+
+class _Failure(object):
+    def __init__(self, error):
+        self.error = error
+
+
+_END_OF_BATCHES = object()
+
+
+class Prefetcher(object):
+    '''Iterates over batches on a background thread, keeping up to depth of them ready
+
+    wait_time accumulates the seconds spent blocked waiting for the next batch and
+    batches counts how many were handed out.
+    '''
+
+    def __init__(self, batches, depth=2):
+        self.wait_time = 0.0
+        self.batches = 0
+        self._queue = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce, args=(batches,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, batches):
+        try:
+            for batch in batches:
+                if not self._put(batch):
+                    return
+        except Exception as e:
+            self._put(_Failure(e))
+            return
+        self._put(_END_OF_BATCHES)
+
+    def __iter__(self):
+        try:
+            while True:
+                start = timeit.default_timer()
+                item = self._queue.get()
+                self.wait_time += timeit.default_timer() - start
+                if item is _END_OF_BATCHES:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                self.batches += 1
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        '''Stops the background thread, batches not yet consumed are discarded
+        '''
+        self._stop.set()
+
+
+class Shard(object):
+    '''The slice of the training set one node of a distributed job works on
+
+    Node rank of world_size gets the rows [n * rank // world_size, n * (rank + 1) // world_size).
+    '''
+
+    def __init__(self, rank=0, world_size=1):
+        assert 0 <= rank < world_size
+        self.rank = rank
+        self.world_size = world_size
+
+    @staticmethod
+    def from_env():
+        '''Reads the rank and world size set by the launcher, a single shard if none is set
+        '''
+        for rank, world_size in SHARD_ENV_VARS:
+            if rank in os.environ and world_size in os.environ:
+                return Shard(int(os.environ[rank]), int(os.environ[world_size]))
+        return Shard()
+
+    def bounds(self, n):
+        return n * self.rank // self.world_size, n * (self.rank + 1) // self.world_size
+
+    def epoch_order(self, n, epoch, seed=0):
+        '''Positions in this node's slice of the n rows, ordered as in the global permutation for epoch
+
+        Every node draws the same permutation from seed and epoch, so they all agree on the global
+        order. The result is cut to the smallest slice so all nodes run the same number of batches.
+        '''
+        start, stop = self.bounds(n)
+        permutation = np.random.RandomState([seed, epoch]).permutation(n)
+        order = permutation[(permutation >= start) & (permutation < stop)] - start
+        return order[:n // self.world_size]
+
+    def __str__(self):
+        return '{}_of_{}'.format(self.rank, self.world_size)
+
+
+def _read_train_shard(datapath, shard):
+    # Assumes every training batch holds the same number of images, as CIFAR-10 does
+    names = [path.join(datapath, 'data_batch_{}'.format(i + 1)) for i in range(NUMBER_OF_TRAINING_BATCHES)]
+    first = NUMBER_OF_TRAINING_BATCHES * shard.rank // shard.world_size
+    batches = {first: read_batch(names[first])}
+    per_batch = len(batches[first]['labels'])
+    start, stop = shard.bounds(per_batch * NUMBER_OF_TRAINING_BATCHES)
+    data, labels = [], []
+    for i in range(start // per_batch, (stop - 1) // per_batch + 1):
+        batch = batches.pop(i) if i in batches else read_batch(names[i])
+        lo, hi = max(start - i * per_batch, 0), min(stop - i * per_batch, per_batch)
+        data.append(batch['data'][lo:hi])
+        labels.append(np.asarray(batch['labels'][lo:hi]))
+    return np.concatenate(data), np.concatenate(labels)
 
 
-def process_cifar(datapath):
+def process_cifar(datapath, shard=None):
     '''Load the training and testing data
+
+    If a Shard is given only its slice of the training set is read, the test set is always whole.
     '''
     print ('Preparing train set...')
-    train_list = [read_batch(path.join(datapath, 'data_batch_{}'.format(i + 1))) for i in range(5)]
-    x_train = np.concatenate([t['data'] for t in train_list])
-    y_train = np.concatenate([t['labels'] for t in train_list])
+    if shard is None or shard.world_size == 1:
+        train_list = [read_batch(path.join(datapath, 'data_batch_{}'.format(i + 1))) for i in range(NUMBER_OF_TRAINING_BATCHES)]
+        x_train = np.concatenate([t['data'] for t in train_list])
+        y_train = np.concatenate([t['labels'] for t in train_list])
+    else:
+        x_train, y_train = _read_train_shard(datapath, shard)
     print ('Preparing test set...')
     tst = read_batch(path.join(datapath, 'test_batch'))
     x_test = tst['data']
@@ -51,50 +261,267 @@ def process_cifar(datapath):
     return x_train, x_test, y_train, y_test
 
 
+def _to_layout(x, channel_first, dtype, lazy):
+    images = x.reshape(-1, 3, 32, 32)
+    if not channel_first:
+        images = np.swapaxes(images, 1, 3)
+    if lazy:
+        return np.ascontiguousarray(images)
+    # Looking every pixel up in a 256 entry table gives exactly x / 255.0 cast to dtype. It is done a
+    # block of rows at a time straight into a C-contiguous array, so there are no full-size temporaries
+    scaled = (np.arange(256) / MAX_PIXEL_VALUE).astype(dtype)
+    out = np.empty(images.shape, dtype=dtype)
+    for start in range(0, len(images), _SCALE_BLOCK_ROWS):
+        stop = start + _SCALE_BLOCK_ROWS
+        np.take(scaled, images[start:stop], out=out[start:stop], mode='clip')
+    return out
+
+
+def _one_hot(labels, classes):
+    return np.equal(labels[:, np.newaxis], classes).astype(np.int32)
 
-def cifar_for_library(datapath, channel_first=True, one_hot=False):
+
+def _cifar_for_library(datapath, channel_first, one_hot, dtype, lazy, shard):
     # Raw data
-    x_train, x_test, y_train, y_test = process_cifar(datapath)
-    # Scale pixel intensity
-    x_train = x_train / 255.0
-    x_test = x_test / 255.0
-    # Reshape
-    x_train = x_train.reshape(-1, 3, 32, 32)
-    x_test = x_test.reshape(-1, 3, 32, 32)
-    # Channel last
-    if not channel_first:
-        x_train = np.swapaxes(x_train, 1, 3)
-        x_test = np.swapaxes(x_test, 1, 3)
-    # One-hot encode y
+    x_train, x_test, y_train, y_test = process_cifar(datapath, shard=shard)
+    # Scale pixel intensity, reshape and move the channels last if needed
+    x_train = _to_layout(x_train, channel_first, dtype, lazy)
+    x_test = _to_layout(x_test, channel_first, dtype, lazy)
+    # One-hot encode y, one column per label value in sorted order
     if one_hot:
-        y_train = np.expand_dims(y_train, axis=-1)
-        y_test = np.expand_dims(y_test, axis=-1)
-        enc = OneHotEncoder(categorical_features='all')
-        fit = enc.fit(y_train)
-        y_train = fit.transform(y_train).toarray()
-        y_test = fit.transform(y_test).toarray()
-    # dtypes
-    x_train = x_train.astype(np.float32)
-    x_test = x_test.astype(np.float32)
-    y_train = y_train.astype(np.int32)
-    y_test = y_test.astype(np.int32)
-    return x_train, x_test, y_train, y_test
+        classes = np.unique(np.concatenate([y_train, y_test]))
+        return x_train, x_test, _one_hot(y_train, classes), _one_hot(y_test, classes)
+    return x_train, x_test, y_train.astype(np.int32), y_test.astype(np.int32)
+
 
+def _source_signature(datapath):
+    signature = []
+    for name in _CIFAR_FILES:
+        stat = os.stat(path.join(datapath, name))
+        signature.append([name, stat.st_size, int(stat.st_mtime)])
+    return signature
+
+
+def _cache_key(channel_first, one_hot, dtype, shard):
+    return 'cifar_{}_{}_{}_{}'.format('channel_first' if channel_first else 'channel_last',
+                                      'one_hot' if one_hot else 'labels',
+                                      np.dtype(dtype).name,
+                                      shard or Shard())
+
+
+def _read_cache(cache_path, signature):
+    meta_file = path.join(cache_path, 'meta.json')
+    if not path.exists(meta_file):
+        return None
+    with open(meta_file, 'r') as f:
+        meta = json.load(f)
+    if meta['version'] != _CACHE_VERSION or meta['source'] != signature:
+        return None
+    # Copy-on-write keeps the arrays writable without touching the shared pages on disk
+    return tuple(np.memmap(path.join(cache_path, name + '.dat'),
+                           dtype=meta['arrays'][name]['dtype'],
+                           mode='c',
+                           shape=tuple(meta['arrays'][name]['shape']))
+                 for name in _CACHED_ARRAYS)
+
+
+@contextmanager
+def _cache_lock(cache_path):
+    # Only one process per entry converts the data and replaces a stale copy, the others wait for it
+    with open(cache_path + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _write_cache(cache_dir, cache_path, signature, arrays):
+    # Called with the entry's lock held. Build in a private directory and rename it into place so
+    # readers never see a partial cache, a stale entry is only removed here so never while in use
+    tmp_path = tempfile.mkdtemp(dir=cache_dir)
+    meta = {'version': _CACHE_VERSION, 'source': signature, 'arrays': {}}
+    for name, array in zip(_CACHED_ARRAYS, arrays):
+        np.ascontiguousarray(array).tofile(path.join(tmp_path, name + '.dat'))
+        meta['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape)}
+    with open(path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    shutil.rmtree(cache_path, ignore_errors=True)
+    os.rename(tmp_path, cache_path)
+
+
+def cifar_for_library(datapath, channel_first=True, one_hot=False, dtype=np.float32, lazy=False,
+                      cache_dir=CACHE_DIR, shard=None):
+    '''Load CIFAR scaled to [0, 1] in the layout the library expects
+
+    With lazy=True the images are returned as uint8 in the requested layout without being scaled or
+    cast, pass normalize=MAX_PIXEL_VALUE to yield_mb to do that one minibatch at a time.
+    If cache_dir is given the result is converted once and stored there as raw arrays, later calls
+    with the same arguments memory-map it instead of unpickling and converting the batches again.
+    For multi-node jobs pass shard=Shard.from_env() to load only this node's slice of the training
+    set and iterate it with yield_mb(order=shard.epoch_order(...)).
+    '''
+    if cache_dir is None:
+        return _cifar_for_library(datapath, channel_first, one_hot, dtype, lazy, shard)
+
+    if not path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            pass
+    signature = _source_signature(datapath)
+    cache_path = path.join(cache_dir, _cache_key(channel_first, one_hot, np.uint8 if lazy else dtype, shard))
+    arrays = _read_cache(cache_path, signature)
+    if arrays is None:
+        with _cache_lock(cache_path):
+            # Another job may have written it while this one waited for the lock
+            arrays = _read_cache(cache_path, signature)
+            if arrays is None:
+                _write_cache(cache_dir, cache_path, signature,
+                             _cifar_for_library(datapath, channel_first, one_hot, dtype, lazy, shard))
+                arrays = _read_cache(cache_path, signature)
+    return arrays
+
+
+def create_logger(influx_client, asynchronous=True, **tags):
+    '''Returns a function that writes a measurement with the given tags to InfluxDB
+
+    By default the client is wrapped in an AsyncInfluxWriter, kept in the function's writer attribute,
+    so points are sent in batches off the calling thread. Pass asynchronous=False to write each point
+    as it is logged. A write that raises does not stop the caller, it is counted in the function's
+    failed attribute and the exception kept in last_error.
+    '''
+    writer = influx_client
+    if asynchronous and not isinstance(influx_client, AsyncInfluxWriter):
+        writer = AsyncInfluxWriter(influx_client)
 
-def create_logger(influx_client, **tags):
     def logger(measurement, **fields):
         try:
-            influx_client.write_points([{
+            writer.write_points([{
                 "measurement": measurement,
                 "tags": tags,
                 "time": datetime.now().strftime('%Y-%m-%dT%H:%M:%S%z'),
                 "fields": fields
             }])
-        except:
-            pass
+        except Exception as e:
+            logger.failed += 1
+            logger.last_error = e
+    logger.writer = writer
+    logger.failed = 0
+    logger.last_error = None
     return logger
 
 
+class _FlushRequest(object):
+    def __init__(self):
+        self.done = threading.Event()
+
+
+_STOP_WRITER = object()
+_FLUSH_CHECK_SEC = 0.1
+
+
+class AsyncInfluxWriter(object):
+    '''Buffers points in a bounded queue and writes them to InfluxDB in batches from a background thread
+
+    It has the same write_points method as the InfluxDB client, create_logger wraps the client in one.
+    A batch is sent once batch_size points are waiting or flush_interval seconds have passed, and
+    whatever is left is flushed on close or at exit. Points that do not fit in the queue or are written
+    after close are counted in dropped, points the client failed to write in failed (with the
+    exception kept in last_error).
+    '''
+
+    def __init__(self, influx_client, batch_size=500, flush_interval=1.0, max_queue_size=10000):
+        self.client = influx_client
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        self.last_error = None
+        self._counter_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write_points(self, points):
+        if not self._thread.is_alive():
+            with self._counter_lock:
+                self.dropped += len(points)
+            return False
+        for point in points:
+            try:
+                self._queue.put_nowait(point)
+            except queue.Full:
+                with self._counter_lock:
+                    self.dropped += 1
+        return True
+
+    def flush(self, timeout=None):
+        '''Blocks until every point queued so far has been sent
+
+        Returns False on timeout, when the queue stays full or if the writer is closed.
+        '''
+        if not self._thread.is_alive():
+            return False
+        deadline = None if timeout is None else timeit.default_timer() + timeout
+        request = _FlushRequest()
+        try:
+            self._queue.put(request, timeout=timeout)
+        except queue.Full:
+            return False
+        # Checked in slices so a writer closed meanwhile does not leave the caller waiting forever
+        while not request.done.wait(_FLUSH_CHECK_SEC):
+            if not self._thread.is_alive() or (deadline is not None and timeit.default_timer() >= deadline):
+                return request.done.is_set()
+        return True
+
+    def close(self, timeout=10):
+        '''Flushes the remaining points and stops the background thread
+        '''
+        if not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP_WRITER, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+    def _send(self, batch):
+        if not batch:
+            return
+        try:
+            self.client.write_points(batch)
+            with self._counter_lock:
+                self.written += len(batch)
+        except Exception as e:
+            with self._counter_lock:
+                self.failed += len(batch)
+                self.last_error = e
+
+    def _run(self):
+        batch = []
+        deadline = timeit.default_timer() + self.flush_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(deadline - timeit.default_timer(), 0))
+            except queue.Empty:
+                item = None
+            is_point = item is not None and item is not _STOP_WRITER and not isinstance(item, _FlushRequest)
+            if is_point:
+                batch.append(item)
+            if not is_point or len(batch) >= self.batch_size:
+                self._send(batch)
+                batch = []
+                deadline = timeit.default_timer() + self.flush_interval
+            if isinstance(item, _FlushRequest):
+                item.done.set()
+            elif item is _STOP_WRITER:
+                return
+
+
 class Timer:    
     def __enter__(self):
         self.start_time = timeit.default_timer()
@@ -102,4 +529,118 @@ class Timer:
 
     def __exit__(self, *args):
         self.end = timeit.default_timer()
-        self.interval = self.end - self.start_time
\ No newline at end of file
+        self.interval = self.end - self.start_time
+
+
+PROFILE_PERCENTILES = (50, 95, 99)
+
+
+class _Samples(object):
+    '''Interval and item count of each run of a section, in arrays that double when full
+    '''
+
+    def __init__(self, capacity):
+        self.intervals = np.empty(capacity, dtype=np.float64)
+        self.items = np.zeros(capacity, dtype=np.int64)
+        self.count = 0
+
+    def add(self, interval, items):
+        if self.count == len(self.intervals):
+            self.intervals = np.resize(self.intervals, 2 * self.count)
+            self.items = np.resize(self.items, 2 * self.count)
+        self.intervals[self.count] = interval
+        self.items[self.count] = items
+        self.count += 1
+
+    def summary(self):
+        intervals = self.intervals[:self.count]
+        total = float(intervals.sum())
+        summary = {'count': self.count, 'total': total, 'mean': total / self.count}
+        for percentile, value in zip(PROFILE_PERCENTILES, np.percentile(intervals, PROFILE_PERCENTILES)):
+            summary['p{}'.format(percentile)] = float(value)
+        items = int(self.items[:self.count].sum())
+        if items:
+            summary['items'] = items
+            summary['throughput'] = items / total if total > 0 else float('inf')
+        return summary
+
+
+class _Section(Timer):
+    def __init__(self, profiler, name, items):
+        self.profiler = profiler
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.path = self.profiler._push(self.name)
+        return Timer.__enter__(self)
+
+    def __exit__(self, *args):
+        Timer.__exit__(self, *args)
+        self.profiler._pop(self.path, self.interval, self.items)
+
+
+class Profiler(object):
+    '''Times named sections that can be nested, keeping every run of each section
+
+    with profiler.section('epoch'):
+        for data, label in profiler.iterate(yield_mb(X, y, 64), 'data', items=64):
+            with profiler.section('compute', items=64):
+                ...
+
+    records 'epoch', 'epoch/data' and 'epoch/compute'. summary gives the count, total, mean,
+    p50, p95 and p99 in seconds of each section, and the throughput in items per second when
+    items are given. Samples go in preallocated arrays of capacity entries, which double when full.
+    A profiler is meant to be used from one thread.
+    '''
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.samples = {}
+        self._stack = []
+
+    def section(self, name, items=0):
+        return _Section(self, name, items)
+
+    def iterate(self, iterable, name='data', items=0):
+        '''Yields from iterable, timing each fetch as a section
+        '''
+        iterator = iter(iterable)
+        while True:
+            section_path = self._push(name)
+            start = timeit.default_timer()
+            try:
+                value = next(iterator)
+            except StopIteration:
+                # The fetch that ends the iteration is not a sample
+                self._stack.pop()
+                return
+            except Exception:
+                self._stack.pop()
+                raise
+            self._pop(section_path, timeit.default_timer() - start, items)
+            yield value
+
+    def _push(self, name):
+        self._stack.append(name)
+        return '/'.join(self._stack)
+
+    def _pop(self, section_path, interval, items):
+        self._stack.pop()
+        samples = self.samples.get(section_path)
+        if samples is None:
+            samples = self.samples[section_path] = _Samples(self.capacity)
+        samples.add(interval, items)
+
+    def summary(self):
+        return dict((section_path, samples.summary()) for section_path, samples in self.samples.items())
+
+    def export(self, logger, prefix='profile '):
+        '''Writes the summary of each section with a logger from create_logger, as measurement
+        prefix + section
+        '''
+        for section_path, summary in sorted(self.summary().items()):
+            logger(prefix + section_path, **summary)
+
+    def reset(self):
+        self.samples = {}
@@ -0,0 +1,625 @@
+''' In-process stand-in for the Batch AI service and the storage file share
+
+Lets the orchestration code in utilities.py and setup_bait.py run without a subscription or a
+network, to count its API calls and time it:
+
+    backend = FakeBackend(job_sec=2, latency=0.05)
+    with installed(backend):
+        stats = measure(backend, setup_bait.submit_all, 'workspace', 'experiment')
+
+Clusters allocate their nodes after allocation_sec, auto-scaled ones as jobs need them, and
+run jobs first in first out on free nodes for job_sec each. Every call sleeps for its latency and fails with the probability given
+in failures, both looked up by operation name, e.g. 'jobs.create'.
+'''
+from __future__ import print_function
+
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from enum import Enum
+
+import azure.mgmt.batchai.models as models
+
+import utilities as ut
+
+URL_SCHEME = 'fake://'
+STDOUT_LINES = 10
+TRAIN_IMAGES = 50000
+# Where the job command tells papermill to write the executed notebook
+NOTEBOOK_PATTERN = re.compile(r'\$AZ_BATCHAI_OUTPUT_NOTEBOOKS/(\S+\.ipynb)')
+
+
+class FakeAPIError(Exception):
+    ''' Raised for injected failures and for resources that do not exist (status_code 404)
+    '''
+
+    def __init__(self, message, status_code=500):
+        super(FakeAPIError, self).__init__(message)
+        self.status_code = status_code
+
+
+class Resource(object):
+    ''' Holds the attributes the code reads from a Batch AI model, as_dict works like the SDK's
+    '''
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+    def as_dict(self):
+        return dict((key, _as_dict_value(value)) for key, value in self.__dict__.items() if value is not None)
+
+
+def _as_dict_value(value):
+    if isinstance(value, Resource):
+        return value.as_dict()
+    if isinstance(value, list):
+        return [_as_dict_value(item) for item in value]
+    if isinstance(value, Enum):
+        return value.value
+    return value
+
+
+def _timestamp(seconds):
+    return None if seconds is None else datetime.fromtimestamp(seconds, timezone.utc)
+
+
+class _Poller(object):
+    ''' Mimics the poller of a long running operation, done after operation_sec
+    '''
+
+    def __init__(self, value, done_at):
+        self._value = value
+        self._done_at = done_at
+
+    def done(self):
+        return time.time() >= self._done_at
+
+    def wait(self, timeout=None):
+        delay = self._done_at - time.time()
+        if timeout is not None:
+            delay = min(delay, timeout)
+        if delay > 0:
+            time.sleep(delay)
+
+    def result(self, timeout=None):
+        self.wait(timeout)
+        return self._value
+
+
+class _Job(object):
+    def __init__(self, workspace, experiment, name, parameters, created, duration, fails):
+        self.workspace = workspace
+        self.experiment = experiment
+        self.name = name
+        self.parameters = parameters
+        self.node_count = parameters.node_count or 1
+        self.created = created
+        self.duration = duration
+        self.fails = fails
+        self.started = None
+        self.ended = None
+        self.nodes = []
+        self.deleted = False
+
+    def state(self, now):
+        if self.started is None:
+            return models.ExecutionState.queued
+        if self.ended > now:
+            return models.ExecutionState.running
+        return models.ExecutionState.failed if self.fails else models.ExecutionState.succeeded
+
+    def progress(self, now):
+        if self.started is None:
+            return 0.0
+        return min(1.0, (now - self.started) / self.duration) if self.duration > 0 else 1.0
+
+
+class _Node(object):
+    def __init__(self, allocated, ready_at):
+        self.allocated = allocated
+        self.ready_at = ready_at
+        self.free_at = ready_at
+
+
+class _Cluster(object):
+    def __init__(self, workspace, name, parameters, now, allocation_sec, allocation_spread_sec, scale_down_sec):
+        self.workspace = workspace
+        self.name = name
+        self.parameters = parameters
+        self.id = '/workspaces/{0}/clusters/{1}'.format(workspace, name)
+        self.allocation_sec = allocation_sec
+        self.allocation_spread_sec = allocation_spread_sec
+        self.scale_down_sec = scale_down_sec
+        self.auto_scale = getattr(parameters.scale_settings, 'auto_scale', None)
+        if self.auto_scale is not None:
+            self.minimum = self.auto_scale.minimum_node_count
+            self.maximum = self.auto_scale.maximum_node_count
+            initial = self.auto_scale.initial_node_count or self.minimum
+        else:
+            self.minimum = self.maximum = initial = parameters.scale_settings.manual.target_node_count
+        self.nodes = []
+        self.released_node_sec = 0.0
+        self.jobs = []
+        self.add_nodes(initial, now)
+
+    def add_nodes(self, count, now):
+        # Nodes become ready one after the other over allocation_spread_sec
+        for node in range(count):
+            spread = self.allocation_spread_sec * node / max(count - 1, 1)
+            self.nodes.append(_Node(now, now + self.allocation_sec + spread))
+
+    def scale(self, now):
+        ''' Grows an auto-scale cluster to the nodes its jobs need and removes nodes idle for scale_down_sec
+        '''
+        demand = sum(job.node_count for job in self.jobs
+                     if not job.deleted and (job.started is None or job.ended > now))
+        if demand > len(self.nodes):
+            self.add_nodes(min(demand, self.maximum) - len(self.nodes), now)
+            return
+        for node in sorted(self.nodes, key=lambda node: node.free_at):
+            if len(self.nodes) <= max(self.minimum, demand) or node.free_at > now - self.scale_down_sec:
+                break
+            self.nodes.remove(node)
+            self.released_node_sec += node.free_at + self.scale_down_sec - node.allocated
+
+    def advance(self, now):
+        ''' Starts the queued jobs, in order, that had enough free nodes by now
+        '''
+        if self.auto_scale is not None:
+            self.scale(now)
+        for job in self.jobs:
+            if job.started is not None or job.deleted:
+                continue
+            if job.node_count > self.maximum or job.node_count > len(self.nodes):
+                break
+            nodes = sorted(self.nodes, key=lambda node: node.free_at)[:job.node_count]
+            start = max(job.created, nodes[-1].free_at)
+            if start > now:
+                break
+            job.started, job.ended, job.nodes = start, start + job.duration, nodes
+            for node in nodes:
+                node.free_at = job.ended
+
+    def ready_nodes(self, now):
+        return [node for node in self.nodes if node.ready_at <= now]
+
+    def busy_nodes(self, now):
+        return sum(1 for node in self.ready_nodes(now) if node.free_at > now)
+
+    def usage(self, now):
+        node_sec = self.released_node_sec + sum(now - node.allocated for node in self.nodes)
+        busy_sec = sum((min(job.ended, now) - job.started) * job.node_count
+                       for job in self.jobs if job.started is not None and job.started <= now)
+        return {'node_sec': node_sec, 'busy_node_sec': busy_sec, 'idle_node_sec': node_sec - busy_sec}
+
+
+class FakeBackend(object):
+    ''' Simulated state of the Batch AI service and the file share, shared by the fake clients
+
+    Nodes are ready allocation_sec after they are requested, spread over allocation_spread_sec.
+    Auto-scale clusters add nodes for queued jobs and remove those idle for scale_down_sec.
+    job_sec is the running time of every job, job_durations overrides it per job name and the jobs
+    in failing_jobs end in the failed state. latency is the time each call takes, latencies and
+    failures map operation names to a latency and to the probability of raising FakeAPIError.
+    calls counts the calls per operation and call_sec the time spent in them.
+    '''
+
+    def __init__(self, allocation_sec=1.0, job_sec=2.0, job_durations=None, failing_jobs=(),
+                 latency=0.0, latencies=None, failures=None, operation_sec=0.0, seed=0,
+                 allocation_spread_sec=0.0, scale_down_sec=5.0):
+        self.allocation_sec = allocation_sec
+        self.allocation_spread_sec = allocation_spread_sec
+        self.scale_down_sec = scale_down_sec
+        self.job_sec = job_sec
+        self.job_durations = job_durations or {}
+        self.failing_jobs = set(failing_jobs)
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.failures = failures or {}
+        self.operation_sec = operation_sec
+        self.calls = Counter()
+        self.call_sec = Counter()
+        self.workspaces = set()
+        self.experiments = set()
+        self.clusters = {}
+        self.jobs = {}
+        self.files = {}
+        self.directories = set()
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+
+    @contextmanager
+    def call(self, operation):
+        ''' Accounts for one call to operation, applying its latency and injected failures
+        '''
+        start = time.time()
+        try:
+            delay = self.latencies.get(operation, self.latency)
+            if delay > 0:
+                time.sleep(delay)
+            with self._lock:
+                failed = self._random.random() < self.failures.get(operation, 0.0)
+            if failed:
+                raise FakeAPIError('Injected failure in {0}'.format(operation))
+            with self._lock:
+                yield
+        finally:
+            with self._lock:
+                self.calls[operation] += 1
+                self.call_sec[operation] += time.time() - start
+
+    def poller(self, value):
+        return _Poller(value, time.time() + self.operation_sec)
+
+    def cluster(self, workspace, name):
+        try:
+            return self.clusters[(workspace, name)]
+        except KeyError:
+            raise FakeAPIError('Cluster {0} not found'.format(name), status_code=404)
+
+    def job(self, workspace, experiment, name):
+        try:
+            return self.jobs[(workspace, experiment, name)]
+        except KeyError:
+            raise FakeAPIError('Job {0} not found'.format(name), status_code=404)
+
+    def advance(self, now):
+        for cluster in self.clusters.values():
+            cluster.advance(now)
+
+    def cluster_resource(self, cluster, now):
+        self.advance(now)
+        ready = len(cluster.ready_nodes(now))
+        running = cluster.busy_nodes(now)
+        preparing = len(cluster.nodes) - ready
+        return Resource(
+            id=cluster.id,
+            name=cluster.name,
+            vm_size=cluster.parameters.vm_size,
+            scale_settings=cluster.parameters.scale_settings,
+            allocation_state=models.AllocationState.resizing if preparing else models.AllocationState.steady,
+            current_node_count=ready,
+            node_state_counts=Resource(idle_node_count=ready - running,
+                                       running_node_count=running,
+                                       preparing_node_count=preparing,
+                                       unusable_node_count=0,
+                                       leaving_node_count=0),
+            errors=None)
+
+    def node_usage(self, workspace, cluster_name, now=None):
+        ''' Returns the node seconds the cluster has been allocated so far, and how many of them were idle
+        '''
+        now = now or time.time()
+        with self._lock:
+            cluster = self.cluster(workspace, cluster_name)
+            self.advance(now)
+            return cluster.usage(now)
+
+    def job_resource(self, job, now):
+        self.advance(now)
+        state = job.state(now)
+        execution_info = None
+        if job.started is not None:
+            finished = state in ut.TERMINAL_STATES
+            errors = None
+            if state == models.ExecutionState.failed:
+                errors = [Resource(code='JobFailed', message='Injected job failure', details=None)]
+            execution_info = Resource(start_time=_timestamp(job.started),
+                                      end_time=_timestamp(job.ended) if finished else None,
+                                      exit_code=(1 if job.fails else 0) if finished else None,
+                                      errors=errors)
+        return Resource(id='/workspaces/{0}/experiments/{1}/jobs/{2}'.format(job.workspace, job.experiment, job.name),
+                        name=job.name,
+                        cluster=job.parameters.cluster,
+                        node_count=job.node_count,
+                        creation_time=_timestamp(job.created),
+                        execution_state=state,
+                        execution_info=execution_info)
+
+    def output_files(self, job, output_directory_id, now):
+        ''' Returns name to content of the files the job has written so far to an output directory
+        '''
+        self.advance(now)
+        if output_directory_id == 'stdOuterr' and job.started is not None:
+            lines = int(job.progress(now) * STDOUT_LINES)
+            stdout = ''.join('{0}: step {1} of {2}\n'.format(job.name, line + 1, STDOUT_LINES)
+                             for line in range(lines))
+            return {'stdout.txt': stdout.encode('utf-8'), 'stderr.txt': b''}
+        if output_directory_id == 'NOTEBOOKS' and job.state(now) in ut.TERMINAL_STATES:
+            match = NOTEBOOK_PATTERN.search(job.parameters.custom_toolkit_settings.command_line)
+            if match:
+                return {match.group(1): json.dumps(self.notebook(job)).encode('utf-8')}
+        return {}
+
+    def notebook(self, job):
+        ''' Returns an executed notebook with the outputs the real notebooks print
+        '''
+        def cell(source, *lines):
+            return {'cell_type': 'code', 'source': source,
+                    'outputs': [{'output_type': 'stream', 'name': 'stdout', 'text': list(lines)}]}
+        cells = [cell('# Parameters\nEPOCHS = 5\n'),
+                 cell('x_train, x_test, y_train, y_test = cifar_for_library(data_path)',
+                      '({0}, 3, 32, 32) (10000, 3, 32, 32) ({0},) (10000,)\n'.format(TRAIN_IMAGES)),
+                 cell('with Timer() as t:\n    ...', 'Training took {0:.3f} sec.\n'.format(job.duration))]
+        if job.fails:
+            cells[-1]['outputs'].append({'output_type': 'error', 'ename': 'RuntimeError', 'evalue': 'Injected job failure'})
+        else:
+            cells.append(cell('print("Accuracy: ", acc)', 'Accuracy:  0.78\n'))
+        return {'cells': cells, 'metadata': {}, 'nbformat': 4, 'nbformat_minor': 2}
+
+    def read_url(self, url, now):
+        ''' Returns the content behind a download_url from list_output_files, None if there is none
+        '''
+        workspace, experiment, name, output_directory_id, file_name = url[len(URL_SCHEME):].split('/')
+        with self._lock:
+            job = self.jobs.get((workspace, experiment, name))
+            if job is None:
+                return None
+            return self.output_files(job, output_directory_id, now).get(file_name)
+
+
+class _ClusterOperations(object):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def create(self, resource_group, workspace, cluster_name, parameters):
+        with self.backend.call('clusters.create'):
+            cluster = _Cluster(workspace, cluster_name, parameters, time.time(), self.backend.allocation_sec,
+                               self.backend.allocation_spread_sec, self.backend.scale_down_sec)
+            self.backend.clusters[(workspace, cluster_name)] = cluster
+            return self.backend.poller(self.backend.cluster_resource(cluster, time.time()))
+
+    def get(self, resource_group, workspace, cluster_name):
+        with self.backend.call('clusters.get'):
+            return self.backend.cluster_resource(self.backend.cluster(workspace, cluster_name), time.time())
+
+    def delete(self, resource_group, workspace, cluster_name):
+        with self.backend.call('clusters.delete'):
+            self.backend.cluster(workspace, cluster_name)
+            del self.backend.clusters[(workspace, cluster_name)]
+            return self.backend.poller(None)
+
+    def list_by_workspace(self, resource_group, workspace):
+        with self.backend.call('clusters.list_by_workspace'):
+            now = time.time()
+            return iter([self.backend.cluster_resource(cluster, now)
+                         for (cluster_workspace, _), cluster in sorted(self.backend.clusters.items())
+                         if cluster_workspace == workspace])
+
+
+class _JobOperations(object):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def create(self, resource_group, workspace, experiment, job_name, parameters):
+        with self.backend.call('jobs.create'):
+            cluster = next((cluster for cluster in self.backend.clusters.values()
+                            if cluster.id == parameters.cluster.id), None)
+            if cluster is None:
+                raise FakeAPIError('Cluster {0} not found'.format(parameters.cluster.id), status_code=404)
+            now = time.time()
+            job = _Job(workspace, experiment, job_name, parameters, now,
+                       self.backend.job_durations.get(job_name, self.backend.job_sec),
+                       job_name in self.backend.failing_jobs)
+            self.backend.jobs[(workspace, experiment, job_name)] = job
+            cluster.jobs.append(job)
+            return self.backend.poller(self.backend.job_resource(job, now))
+
+    def get(self, resource_group, workspace, experiment, job_name):
+        with self.backend.call('jobs.get'):
+            return self.backend.job_resource(self.backend.job(workspace, experiment, job_name), time.time())
+
+    def delete(self, resource_group, workspace, experiment, job_name):
+        with self.backend.call('jobs.delete'):
+            job = self.backend.job(workspace, experiment, job_name)
+            now = time.time()
+            self.backend.advance(now)
+            job.deleted = True
+            for cluster in self.backend.clusters.values():
+                if job in cluster.jobs:
+                    cluster.jobs.remove(job)
+                    if job.state(now) == models.ExecutionState.running:
+                        for node in job.nodes:
+                            node.free_at = now
+            del self.backend.jobs[(workspace, experiment, job_name)]
+            return self.backend.poller(None)
+
+    def list_by_experiment(self, resource_group, workspace, experiment, jobs_list_by_experiment_options=None):
+        ''' Returns the jobs page by page as they are iterated, like the SDK's paged results
+        '''
+        page_size = getattr(jobs_list_by_experiment_options, 'max_results', None) or 1000
+        names = None
+        start = 0
+        while names is None or start < len(names):
+            with self.backend.call('jobs.list_by_experiment'):
+                if names is None:
+                    names = sorted(key for key in self.backend.jobs if key[:2] == (workspace, experiment))
+                now = time.time()
+                page = [self.backend.job_resource(self.backend.jobs[key], now)
+                        for key in names[start:start + page_size] if key in self.backend.jobs]
+            for job in page:
+                yield job
+            start += page_size
+
+    def list_output_files(self, resource_group, workspace, experiment, job_name, jobs_list_output_files_options):
+        with self.backend.call('jobs.list_output_files'):
+            job = self.backend.job(workspace, experiment, job_name)
+            output_directory_id = jobs_list_output_files_options.outputdirectoryid
+            files = self.backend.output_files(job, output_directory_id, time.time())
+            return iter([Resource(name=name,
+                                  content_length=len(content),
+                                  download_url='{0}{1}/{2}/{3}/{4}/{5}'.format(URL_SCHEME, workspace, experiment,
+                                                                                job_name, output_directory_id, name))
+                         for name, content in sorted(files.items())])
+
+
+class _NamedOperations(object):
+    ''' Operations on workspaces or experiments, which only need to exist
+    '''
+
+    def __init__(self, backend, kind, names):
+        self.backend = backend
+        self.kind = kind
+        self.names = names
+
+    def create(self, resource_group, *args):
+        with self.backend.call('{0}.create'.format(self.kind)):
+            # Workspaces are also given a location
+            key = args[:-1] if self.kind == 'workspaces' else args
+            self.names.add(key)
+            return self.backend.poller(Resource(name=key[-1]))
+
+    def get(self, resource_group, *key):
+        with self.backend.call('{0}.get'.format(self.kind)):
+            if key not in self.names:
+                raise FakeAPIError('{0} not found'.format(key[-1]), status_code=404)
+            return Resource(name=key[-1])
+
+    def delete(self, resource_group, *key):
+        with self.backend.call('{0}.delete'.format(self.kind)):
+            if key not in self.names:
+                raise FakeAPIError('{0} not found'.format(key[-1]), status_code=404)
+            self.names.remove(key)
+            return self.backend.poller(None)
+
+
+class FakeBatchAIClient(object):
+    ''' Has the operations of BatchAIManagementClient that utilities.py and setup_bait.py use
+    '''
+
+    def __init__(self, backend):
+        self.clusters = _ClusterOperations(backend)
+        self.jobs = _JobOperations(backend)
+        self.workspaces = _NamedOperations(backend, 'workspaces', backend.workspaces)
+        self.experiments = _NamedOperations(backend, 'experiments', backend.experiments)
+
+
+class FakeFileService(object):
+    ''' Has the methods of azure.storage.file.FileService that upload_scripts uses
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def exists(self, share_name, directory_name=None, file_name=None):
+        with self.backend.call('files.exists'):
+            if file_name is not None:
+                return (share_name, directory_name, file_name) in self.backend.files
+            return (share_name, directory_name) in self.backend.directories
+
+    def create_directory(self, share_name, directory_name, fail_on_exist=False):
+        with self.backend.call('files.create_directory'):
+            created = (share_name, directory_name) not in self.backend.directories
+            if not created and fail_on_exist:
+                raise FakeAPIError('Directory {0} exists'.format(directory_name), status_code=409)
+            self.backend.directories.add((share_name, directory_name))
+            return created
+
+    def create_file_from_path(self, share_name, directory_name, file_name, local_file_path):
+        with open(local_file_path, 'rb') as f:
+            content = f.read()
+        with self.backend.call('files.create_file'):
+            self.backend.files[(share_name, directory_name, file_name)] = content
+
+    def create_file_from_text(self, share_name, directory_name, file_name, text):
+        with self.backend.call('files.create_file'):
+            self.backend.files[(share_name, directory_name, file_name)] = text.encode('utf-8')
+
+    def get_file_to_text(self, share_name, directory_name, file_name):
+        with self.backend.call('files.get_file'):
+            content = self.backend.files.get((share_name, directory_name, file_name))
+            if content is None:
+                raise FakeAPIError('File {0} not found'.format(file_name), status_code=404)
+            return Resource(name=file_name, content=content.decode('utf-8'))
+
+
+class _Response(object):
+    def __init__(self, status_code, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise IOError('HTTP {0}'.format(self.status_code))
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+
+class FakeSession(object):
+    ''' Serves the download_url of fake output files in place of requests.Session, honouring ranges
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def head(self, url, **kwargs):
+        with self.backend.call('http.head'):
+            content = self.backend.read_url(url, time.time())
+        if content is None:
+            return _Response(404)
+        return _Response(200, headers={'Content-Length': str(len(content)), 'Accept-Ranges': 'bytes'})
+
+    def get(self, url, headers=None, **kwargs):
+        with self.backend.call('http.get'):
+            content = self.backend.read_url(url, time.time())
+        if content is None:
+            return _Response(404)
+        byte_range = (headers or {}).get('Range')
+        if not byte_range:
+            return _Response(200, content)
+        start, _, end = byte_range[len('bytes='):].partition('-')
+        return _Response(206, content[int(start):int(end) + 1 if end else None])
+
+
+class _Credentials(object):
+    def __init__(self, **kwargs):
+        self.token = {'expires_on': time.time() + 3600}
+
+
+def _reset_cached_state():
+    ut._clients.clear()
+    ut._session = None
+    with ut._jobs_cache_lock:
+        ut._jobs_cache.clear()
+
+
+@contextmanager
+def installed(backend):
+    ''' Makes utilities.py, and so setup_bait.py, talk to backend instead of Azure while in the block
+    '''
+    factories = (ut.credentials_factory, ut.client_factory, ut.file_service_factory, ut.session_factory)
+    ut.credentials_factory = _Credentials
+    ut.client_factory = lambda *args, **kwargs: FakeBatchAIClient(backend)
+    ut.file_service_factory = lambda *args, **kwargs: FakeFileService(backend)
+    ut.session_factory = lambda: FakeSession(backend)
+    _reset_cached_state()
+    try:
+        yield backend
+    finally:
+        ut.credentials_factory, ut.client_factory, ut.file_service_factory, ut.session_factory = factories
+        _reset_cached_state()
+
+
+def measure(backend, function, *args, **kwargs):
+    ''' Calls function and returns its result with the wall time and the API calls it made
+    '''
+    calls_before = Counter(backend.calls)
+    start = time.time()
+    result = function(*args, **kwargs)
+    wall_sec = time.time() - start
+    calls = backend.calls - calls_before
+    return {'result': result,
+            'wall_sec': wall_sec,
+            'calls': dict(calls),
+            'total_calls': sum(calls.values())}
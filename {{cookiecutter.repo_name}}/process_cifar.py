@@ -3,20 +3,25 @@ try:
     from urllib.request import urlretrieve
 except ImportError:
     from urllib import urlretrieve
+import io
+import json
+import mmap
 import sys
 import tarfile
 import os
+import multiprocessing
 import numpy as np
 import pickle as cp
 from PIL import Image
-import xml.etree.cElementTree as et
-import xml.dom.minidom
-from itertools import product, count
 import fire
 
 
 IMGSIZE = 32
 NUMBER_OF_TRAINING_BATCHES = 5
+PAD = 4
+CHUNK_SIZE = 500
+SHARD_SIZE = 10000
+NUMBER_OF_LEVELS = 256
 CIFAR_URL = 'http://www.cs.toronto.edu/~kriz/cifar-10-python.tar.gz'
 DATA_DIR = 'data'
 
@@ -38,38 +43,275 @@ def extract(fname):
         os.remove(fname)
 
 
-def _pad_image(pixData, pad):
-    return np.pad(pixData, ((0, 0), (pad, pad), (pad, pad)), mode='constant',
-                  constant_values=128)  # can also use mode='edge'
+MEAN_TEMPLATE = """<?xml version="1.0" ?>
+<opencv_storage>
+  <Channel>3</Channel>
+  <Row>{size}</Row>
+  <Col>{size}</Col>
+  <MeanImg type_id="opencv-matrix">
+    <rows>1</rows>
+    <cols>{cols}</cols>
+    <dt>f</dt>
+    <data>{data}</data>
+  </MeanImg>
+</opencv_storage>
+"""
 
 
 def saveMean(fname, data):
-    root = et.Element('opencv_storage')
-    et.SubElement(root, 'Channel').text = '3'
-    et.SubElement(root, 'Row').text = str(IMGSIZE)
-    et.SubElement(root, 'Col').text = str(IMGSIZE)
-    meanImg = et.SubElement(root, 'MeanImg', type_id='opencv-matrix')
-    et.SubElement(meanImg, 'rows').text = '1'
-    et.SubElement(meanImg, 'cols').text = str(IMGSIZE * IMGSIZE * 3)
-    et.SubElement(meanImg, 'dt').text = 'f'
-    et.SubElement(meanImg, 'data').text = ' '.join(['%e' % n for n in np.reshape(data, (IMGSIZE * IMGSIZE * 3))])
-
-    tree = et.ElementTree(root)
-    tree.write(fname)
-    x = xml.dom.minidom.parse(fname)
     with open(fname, 'w') as f:
-        f.write(x.toprettyxml(indent='  '))
+        f.write(MEAN_TEMPLATE.format(size=IMGSIZE,
+                                     cols=IMGSIZE * IMGSIZE * 3,
+                                     data=' '.join(['%e' % n for n in np.reshape(data, (IMGSIZE * IMGSIZE * 3))])))
+
+
+def compute_statistics(batches):
+    """ Computes the mean image (CHW), per-channel mean and std and per-channel pixel histograms
+
+    Works one batch at a time. Sums and histograms are accumulated as exact integers and the
+    channel moments are derived from the histograms, so the result does not depend on batch order.
+    """
+    count = 0
+    pixel_sum = np.zeros(3 * IMGSIZE * IMGSIZE, dtype=np.int64)
+    histogram = np.zeros((3, NUMBER_OF_LEVELS), dtype=np.int64)
+    for _, data in batches:
+        count += len(data)
+        pixel_sum += data.sum(axis=0, dtype=np.int64)
+        for channel, pixels in enumerate(np.split(data, 3, axis=1)):
+            histogram[channel] += np.bincount(pixels.ravel(), minlength=NUMBER_OF_LEVELS)
+
+    levels = np.arange(NUMBER_OF_LEVELS, dtype=np.float64)
+    pixels_per_channel = histogram.sum(axis=1).astype(np.float64)
+    channel_mean = histogram.dot(levels) / pixels_per_channel
+    channel_var = (histogram * (levels - channel_mean[:, None]) ** 2).sum(axis=1) / pixels_per_channel
+    return {'count': count,
+            'mean_image': (pixel_sum / float(count)).reshape((3, IMGSIZE, IMGSIZE)),
+            'channel_mean': channel_mean,
+            'channel_std': np.sqrt(channel_var),
+            'histogram': histogram}
+
+
+def saveStatistics(frompath='cifar-10-batches-py', mean_filename='CIFAR-10_mean.xml',
+                   stats_filename='CIFAR-10_stats.json', stats=None):
+    """ Regenerates the mean file and the per-channel statistics without exporting any images
+
+    Pass mean_filename=None to only write the statistics. stats from compute_statistics are
+    written as they are, otherwise they are computed from the batches in frompath.
+    """
+    if stats is None:
+        stats = compute_statistics(_train_batches(frompath))
+    if mean_filename:
+        saveMean(mean_filename, stats['mean_image'])
+    with open(stats_filename, 'w') as f:
+        json.dump({'count': stats['count'],
+                   'channel_mean': stats['channel_mean'].tolist(),
+                   'channel_std': stats['channel_std'].tolist(),
+                   'histogram': stats['histogram'].tolist()}, f)
+    return stats
+
+
+def _images_to_hwc(data, pad):
+    """ Converts a (N, 3 * IMGSIZE * IMGSIZE) batch of CIFAR rows into padded (N, H, W, 3) uint8 images
+    """
+    images = data.reshape((-1, 3, IMGSIZE, IMGSIZE))
+    if pad > 0:
+        images = np.pad(images, ((0, 0), (0, 0), (pad, pad), (pad, pad)), mode='constant',
+                        constant_values=128)
+    return np.ascontiguousarray(images.transpose(0, 2, 3, 1), dtype=np.uint8)
 
 
 def saveImage(fname, pixData, pad):
-    if pad > 0:
-        pixData = _pad_image(pixData, pad)
+    Image.fromarray(_images_to_hwc(pixData, pad)[0], 'RGB').save(fname)
+
+
+def _image_name(index):
+    return '%05d.png' % index
+
+
+def _save_chunk(args):
+    topath, start, data, pad = args
+    for index, pixels in enumerate(_images_to_hwc(data, pad), start):
+        Image.fromarray(pixels, 'RGB').save(os.path.join(topath, _image_name(index)))
+    return len(data)
+
+
+def _chunks(topath, batches, pad, chunk_size):
+    start = 0
+    for _, data in batches:
+        for offset in range(0, len(data), chunk_size):
+            chunk = data[offset:offset + chunk_size]
+            yield topath, start, chunk, pad
+            start += len(chunk)
+
+
+def export_images(topath, batches, pad=PAD, workers=1, chunk_size=CHUNK_SIZE):
+    """ Writes every image in batches as a PNG in topath and returns the number of images written
+
+    batches is an iterable of (labels, data) tuples as returned by load_batch. Images are numbered
+    consecutively across batches. If workers is None all available CPUs are used.
+    """
+    if not os.path.exists(topath):
+        os.makedirs(topath)
+    workers = workers or multiprocessing.cpu_count()
+    tasks = _chunks(topath, batches, pad, chunk_size)
+    if workers == 1:
+        return sum(_save_chunk(task) for task in tasks)
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        return sum(pool.imap_unordered(_save_chunk, tasks))
+    finally:
+        pool.close()
+        pool.join()
+
+
+# Where each image of a packed dataset is, see ShardWriter
+INDEX_DTYPE = np.dtype([('shard', '<u2'), ('offset', '<u8'), ('length', '<u4'), ('label', '<i4')])
+
+
+def _shard_name(prefix, shard):
+    return '%s_%05d.shard' % (prefix, shard)
+
+
+def _index_name(prefix):
+    return prefix + '_index.npy'
+
+
+class ShardWriter(object):
+    """ Appends encoded images to shard files of shard_size images each and writes their index
+
+    The shards are named prefix_00000.shard, prefix_00001.shard and so on and hold the PNG files
+    back to back. prefix_index.npy is an INDEX_DTYPE array with the shard, offset, length and label
+    of every image, written on close.
+    """
+
+    def __init__(self, topath, prefix, shard_size=SHARD_SIZE):
+        if not os.path.exists(topath):
+            os.makedirs(topath)
+        self.topath = topath
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self._entries = []
+        self._file = None
+
+    def add(self, encoded, label):
+        shard, position = divmod(len(self._entries), self.shard_size)
+        if position == 0:
+            if self._file:
+                self._file.close()
+            self._file = open(os.path.join(self.topath, _shard_name(self.prefix, shard)), 'wb')
+        self._entries.append((shard, self._file.tell(), len(encoded), label))
+        self._file.write(encoded)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        np.save(os.path.join(self.topath, _index_name(self.prefix)), np.array(self._entries, dtype=INDEX_DTYPE))
+        return len(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __enter__(self):
+        return self
 
-    img = Image.new('RGB', (IMGSIZE + 2 * pad, IMGSIZE + 2 * pad))
-    pixels = img.load()
-    for x, y in product(range(img.size[0]), range(img.size[1])):
-        pixels[x, y] = (pixData[0][y][x], pixData[1][y][x], pixData[2][y][x])
-    img.save(fname)
+    def __exit__(self, *args):
+        self.close()
+
+
+class ShardedDataset(object):
+    """ Random access to a dataset written by ShardWriter
+
+    dataset[i] is image i as a (H, W, 3) uint8 array and read_bytes(i) its PNG file. The shards are
+    memory-mapped when first read.
+    """
+
+    def __init__(self, frompath, prefix):
+        self.frompath = frompath
+        self.prefix = prefix
+        self.index = np.load(os.path.join(frompath, _index_name(prefix)))
+        self._shards = {}
+
+    @property
+    def labels(self):
+        return self.index['label']
+
+    def __len__(self):
+        return len(self.index)
+
+    def _shard(self, shard):
+        if shard not in self._shards:
+            with open(os.path.join(self.frompath, _shard_name(self.prefix, shard)), 'rb') as f:
+                self._shards[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._shards[shard]
+
+    def read_bytes(self, index):
+        shard, offset, length, _ = self.index[index]
+        return self._shard(int(shard))[int(offset):int(offset) + int(length)]
+
+    def __getitem__(self, index):
+        return np.asarray(Image.open(io.BytesIO(self.read_bytes(index))))
+
+    def indices_for_label(self, label):
+        return np.flatnonzero(self.labels == label)
+
+    def images_for_label(self, label):
+        for index in self.indices_for_label(label):
+            yield self[index]
+
+    def close(self):
+        for shard in self._shards.values():
+            shard.close()
+        self._shards = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _encode_chunk(args):
+    _, _, data, pad = args
+    encoded = []
+    for pixels in _images_to_hwc(data, pad):
+        buffer = io.BytesIO()
+        Image.fromarray(pixels, 'RGB').save(buffer, format='PNG')
+        encoded.append(buffer.getvalue())
+    return encoded
+
+
+def export_shards(topath, prefix, batches, pad=PAD, workers=1, chunk_size=CHUNK_SIZE, shard_size=SHARD_SIZE):
+    """ Writes every image in batches as a PNG into the shards of a packed dataset, see ShardWriter
+
+    Returns the number of images written. If workers is None all available CPUs are used.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    labels = np.concatenate([labels for labels, _ in batches])
+    tasks = _chunks(topath, batches, pad, chunk_size)
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        chunks = pool.imap(_encode_chunk, tasks) if pool else map(_encode_chunk, tasks)
+        with ShardWriter(topath, prefix, shard_size) as writer:
+            for encoded, label in zip((png for chunk in chunks for png in chunk), labels):
+                writer.add(encoded, int(label))
+        return len(writer)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+
+def convert_png_layout(map_filename, image_path, topath, prefix, shard_size=SHARD_SIZE):
+    """ Packs the PNGs listed in a map file (image name, tab, label per line) under image_path into shards
+    """
+    with open(map_filename) as mapFile, ShardWriter(topath, prefix, shard_size) as writer:
+        for line in mapFile:
+            name, label = line.rstrip('\n').split('\t')
+            with open(os.path.join(image_path, name), 'rb') as f:
+                writer.add(f.read(), int(label))
+    return len(writer)
 
 
 def load_data_file(f):
@@ -89,50 +331,90 @@ def read_test_batch(frompath):
 
 
 def read_batch(filename):
+    labels, data = load_batch(filename)
+    for i in range(len(labels)):
+        yield labels[i], data[i, :].reshape((3, IMGSIZE, IMGSIZE))
+
+
+def load_batch(filename):
     with open(filename, 'rb') as f:
         labels, data = load_data_file(f)
-        for i in range(len(labels)):
-            yield labels[i], data[i, :].reshape((3, IMGSIZE, IMGSIZE))
+    return np.asarray(labels), data
 
 
-def saveTrainImages(topath, map_filename='train_map.txt', mean_filename='CIFAR-10_mean.xml',
-                    frompath='cifar-10-batches-py'):
-    if not os.path.exists(topath):
-        os.makedirs(topath)
+def _train_batches(frompath):
+    for ifile in range(1, NUMBER_OF_TRAINING_BATCHES + 1):
+        yield load_batch(os.path.join(frompath, "data_batch_{}".format(ifile)))
 
-    file_num_generator = count(start=0, step=1)
-    dataSum = np.zeros((3, IMGSIZE, IMGSIZE))  # mean is in CHW format.
-    with open(map_filename, 'w') as mapFile:
-        for ifile in range(1, NUMBER_OF_TRAINING_BATCHES + 1):  # Loop through batches
-            for label, data in read_train_batch(frompath, ifile):
-                fname = '%05d.png' % next(file_num_generator)
-                saveImage(os.path.join(topath, fname), data, 4)
-                mapFile.write("%s\t%d\n" % (fname, label))
-                dataSum += data
-    saveMean(mean_filename, dataSum / next(file_num_generator))
 
+def _test_batches(frompath):
+    yield load_batch(os.path.join(frompath, "test_batch"))
 
-def saveTestImages(topath, filename='test_map.txt', frompath='cifar-10-batches-py'):
-    if not os.path.exists(topath):
-        os.makedirs(topath)
 
-    file_num_generator = count(start=0, step=1)
+def saveMap(filename, batches):
+    """ Writes the image to label map and returns the labels as one array
+    """
+    labels = np.concatenate([labels for labels, _ in batches])
     with open(filename, 'w') as mapFile:
-        for label, data in read_test_batch(frompath):
-            fname = '%05d.png' % next(file_num_generator)
-            saveImage(os.path.join(topath, fname), data, 4)
-            mapFile.write("%s\t%d\n" % (fname, label))
+        for index, label in enumerate(labels):
+            mapFile.write("%s\t%d\n" % (_image_name(index), label))
+    return labels
 
 
-def main(data_dir=DATA_DIR):
+def saveTrainImages(topath, map_filename='train_map.txt', mean_filename='CIFAR-10_mean.xml',
+                    frompath='cifar-10-batches-py', workers=1):
+    """ Exports the training images with their map and mean files, returns the compute_statistics result
+    """
+    batches = list(_train_batches(frompath))
+    export_images(topath, batches, workers=workers)
+    saveMap(map_filename, batches)
+    stats = compute_statistics(batches)
+    saveMean(mean_filename, stats['mean_image'])
+    return stats
+
+
+def saveTestImages(topath, filename='test_map.txt', frompath='cifar-10-batches-py', workers=1):
+    batches = list(_test_batches(frompath))
+    export_images(topath, batches, workers=workers)
+    saveMap(filename, batches)
+
+
+def export(data_dir=DATA_DIR, frompath='cifar-10-batches-py', workers=None, packed=False):
+    """ Exports the extracted batches in frompath as PNGs with their map, mean and statistics files
+
+    With packed the images go into the train and test shards of a packed dataset in data_dir
+    instead of one file each, the labels are in its index so no map files are written.
+    """
+    # The statistics are computed once, from the training batches already loaded for the export
+    if packed:
+        batches = list(_train_batches(frompath))
+        export_shards(data_dir, 'train', batches, workers=workers)
+        export_shards(data_dir, 'test', list(_test_batches(frompath)), workers=workers)
+        stats = compute_statistics(batches)
+        mean_filename = os.path.join(data_dir, 'CIFAR-10_mean.xml')
+    else:
+        stats = saveTrainImages(os.path.join(data_dir, 'train'),
+                                map_filename=os.path.join(data_dir, 'train_map.txt'),
+                                mean_filename=os.path.join(data_dir, 'CIFAR-10_mean.xml'),
+                                frompath=frompath,
+                                workers=workers)
+        saveTestImages(os.path.join(data_dir, 'test'), os.path.join(data_dir, 'test_map.txt'),
+                       frompath=frompath, workers=workers)
+        mean_filename = None
+    saveStatistics(frompath=frompath,
+                   mean_filename=mean_filename,
+                   stats_filename=os.path.join(data_dir, 'CIFAR-10_stats.json'),
+                   stats=stats)
+
+
+def main(data_dir=DATA_DIR, workers=None, packed=False):
+    """ Downloads CIFAR-10 and exports it as PNGs, workers defaults to the number of CPUs
+
+    Pass --packed to write a few shard files instead of 60,000 PNGs.
+    """
     fname = download_data(CIFAR_URL)
     extract(fname)
-    train_path = os.path.join(data_dir, 'train')
-    test_path = os.path.join(data_dir, 'test')
-    saveTrainImages(train_path,
-                    map_filename=os.path.join(data_dir, 'train_map.txt'),
-                    mean_filename=os.path.join(data_dir, 'CIFAR-10_mean.xml'))
-    saveTestImages(test_path, os.path.join(data_dir, 'test_map.txt'))
+    export(data_dir, workers=workers, packed=packed)
 
 
 if __name__=='__main__':
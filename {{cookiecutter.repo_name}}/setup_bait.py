@@ -4,6 +4,9 @@
 import logging
 logging.basicConfig(level=logging.ERROR)
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 from glob import iglob
 from itertools import chain
 from os import path
@@ -25,10 +28,24 @@ IMAGE_NAMES = ["masalvar/cntk_bait",
                "masalvar/tf_bait"]
 
 LOGGER_URL=os.getenv('LOGGER_URL', default="dbait.eastus.cloudapp.azure.com")
+# run_notebook.sh stages the dataset on the node's local disk with prepare_data.sh and runs the
+# notebook on it, cifar_for_library keeps its converted arrays next to it for the following jobs.
+# Both caches are in AZ_BATCH_NODE_SHARED_DIR, which the job containers on a node share
 COMMAND_TEMPLATE='bash -c "\
-	cd $AZ_BATCHAI_INPUT_SCRIPT && \
-	papermill {input_nb} $AZ_BATCHAI_OUTPUT_NOTEBOOKS/{output_nb} \
-	-p EPOCHS {epochs} -p LOGGER_URL {logger_url} --log-output --no-progress-bar"'
+	bash $AZ_BATCHAI_INPUT_SCRIPT/run_notebook.sh {input_nb} $AZ_BATCHAI_OUTPUT_NOTEBOOKS/{output_nb} \
+	-p EPOCHS {epochs} -p LOGGER_URL {logger_url}"'
+
+# (job name, notebook prefix, docker image) of the jobs submit_all sends
+FRAMEWORK_JOBS = (('run_cntk', 'CNTK', 'masalvar/cntk_bait'),
+                  ('run_chainer', 'Chainer', 'masalvar/chainer_bait'),
+                  ('run_mxnet', 'MXNet', 'masalvar/mxnet_bait'),
+                  ('run_keras_cntk', 'Keras_CNTK', 'masalvar/keras_bait'),
+                  ('run_keras_tf', 'Keras_TF', 'masalvar/keras_bait'),
+                  ('run_caffe2', 'Caffe2', 'masalvar/caffe2_bait'),
+                  ('run_pytorch', 'PyTorch', 'masalvar/pytorch_bait'),
+                  ('run_tf', 'Tensorflow', 'masalvar/tf_bait'),
+                  ('run_gluon', 'Gluon', 'masalvar/mxnet_bait'))
+SUBMISSION_WORKERS = 4
 
 
 def encode(value):
@@ -37,7 +54,8 @@ def encode(value):
     return value.encode('utf-8')
 
 
-def current_bait_config(node_count=NODE_COUNT, cluster_name=CLUSTER_NAME, image_names=IMAGE_NAMES):
+def current_bait_config(node_count=NODE_COUNT, cluster_name=CLUSTER_NAME, image_names=IMAGE_NAMES,
+                        min_node_count=None, max_node_count=None):
     return {
         "subscription_id": os.getenv('SUBSCRIPTION_ID'),
         "client_id": os.getenv('APP_ID'),
@@ -57,6 +75,9 @@ def current_bait_config(node_count=NODE_COUNT, cluster_name=CLUSTER_NAME, image_
             "password": "Dem0Pa$$w0rd"
         },
         "node_count": node_count,
+        # With a max_node_count the cluster auto-scales, see ut.scale_settings_for
+        "min_node_count": min_node_count,
+        "max_node_count": max_node_count,
         "cluster_name": cluster_name,
         "image_names": image_names,
         "fileshare_name": os.getenv('FILE_SHARE_NAME'),
@@ -66,17 +87,46 @@ def current_bait_config(node_count=NODE_COUNT, cluster_name=CLUSTER_NAME, image_
     }
 
 
-config = ut.Configuration.from_dict(current_bait_config())
+class _Lazy(object):
+    """ Stands in for the object returned by factory, which is only called on first use
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+
+    def __getattr__(self, name):
+        return getattr(self._factory(), name)
+
+    def __repr__(self):
+        return repr(self._factory())
+
+    def __str__(self):
+        return str(self._factory())
+
+
+_config = None
+
+
+def current_config():
+    """ Returns the configuration, read from the environment the first time it is needed
+    """
+    global _config
+    if _config is None:
+        _config = ut.Configuration.from_dict(current_bait_config())
+    return _config
+
+
+config = _Lazy(current_config)
 
 ####### Cluster Functions #######################
 
 def current_client():
-    """ Returns the current Batch AI client
+    """ Returns the current Batch AI client, created on first use and then reused
     """
-    return ut.client_from(config)
+    return ut.client_from(current_config())
 
 
-client = current_client()
+client = _Lazy(current_client)
 
 
 def current_cluster(workspace):
@@ -97,31 +147,35 @@ def delete_cluster(workspace):
     return client.clusters.delete(config.group_name, workspace, config.cluster_name)
 
     
-def print_cluster_list(workspace, resource_group=config.group_name):
+def print_cluster_list(workspace, resource_group=None):
     """ Print cluster info
     """
-    pprint([cl.as_dict() for cl in client.clusters.list_by_workspace(resource_group, workspace)])
+    pprint([cl.as_dict() for cl in client.clusters.list_by_workspace(resource_group or config.group_name, workspace)])
 
     
-def setup_cluster(workspace):
+def setup_cluster(workspace, min_node_count=None, max_node_count=None):
     """ Sets up the Batch AI cluster
+
+    Given a max_node_count the cluster auto-scales between min_node_count and max_node_count
+    nodes with the jobs, otherwise it has node_count nodes until it is deleted.
     """
-    ut.setup_cluster(config, workspace)
+    ut.setup_cluster(config, workspace, min_node_count=min_node_count, max_node_count=max_node_count)
 
 
-def wait_for_cluster(workspace):
-    """ Will wait until the cluster is provisioned
+def wait_for_cluster(workspace, min_ready_nodes=1):
+    """ Will wait until the cluster has min_ready_nodes idle nodes, None waits for all the nodes
     """
-    ut.wait_for_cluster(config, config.group_name, workspace, config.cluster_name)
+    ut.wait_for_cluster(config, config.group_name, workspace, config.cluster_name,
+                        min_ready_nodes=min_ready_nodes)
 
 
 ####### Jobs Functions #######################
 
-def _upload_job_scripts(job_name):
+def _upload_job_scripts(directory):
     files = chain.from_iterable([iglob(path.join('exec_src', '*.ipynb')),
                                  iglob(path.join('exec_src', '*.sh')),
                                  iglob(path.join('exec_src', '*.py'))])
-    ut.upload_scripts(config, job_name, files)
+    ut.upload_scripts(config, directory, files)
 
 
 
@@ -214,8 +268,8 @@ def submit_pytorch_job(workspace, experiment, job_name='run_pytorch', epochs=5,
     """
     logger.info('Submitting job {}'.format(job_name))
     _upload_job_scripts(job_name)
-    command = COMMAND_TEMPLATE.format(input_nb='Pytorch_CIFAR.ipynb',
-                                      output_nb='Pytorch_{}.ipynb'.format(job_name),
+    command = COMMAND_TEMPLATE.format(input_nb='PyTorch_CIFAR.ipynb',
+                                      output_nb='PyTorch_{}.ipynb'.format(job_name),
                                       epochs=epochs,
                                       logger_url=logger_url)
     ut.create_job(config, current_cluster(workspace).id, workspace, experiment, job_name, 'masalvar/pytorch_bait', command)
@@ -239,11 +293,30 @@ def wait_for_job(workspace, experiment, job_name):
     ut.wait_for_job(config, workspace, experiment, job_name)
 
 
+def wait_for_jobs(workspace, experiment, job_names=None, stream_output=False):
+    """ Waits for several jobs at once, all the jobs in the experiment by default
+
+    With stream_output the stdout and stderr of every job are printed as they are written.
+    Returns a summary with the final state and the time each job spent queued and running
+    """
+    if job_names is None:
+        job_names = [job.name for job in ut.iter_jobs(client, workspace, experiment, resource_group=config.group_name)]
+    summary = ut.wait_for_jobs(config, workspace, experiment, job_names, stream_output=stream_output)
+    for job_name, job in sorted(summary.items()):
+        print('{}: status:{} | exit-code {} | queued {} sec | running {} sec'.format(job_name,
+                                                                                   job['state'],
+                                                                                   job['exit_code'],
+                                                                                   job['queued_sec'],
+                                                                                   job['running_sec']))
+    return summary
+
+
 def delete_job(workspace, experiment, job_name):
     """ Deletes the job
     """
     logger.info('Deleting job {}'.format(job_name))
     client.jobs.delete(config.group_name, workspace, experiment, job_name)
+    ut.invalidate_jobs_cache(config.group_name, workspace, experiment)
 
 
 def list_output_files(workspace, experiment, job_name, output_id):
@@ -270,11 +343,33 @@ def download_files(workspace, experiment, job_name, output_id, output_folder=Non
         logger.info('Downloading files to {}'.format(output_folder))
 
     files = client.jobs.list_output_files(config.group_name, workspace, experiment, job_name, models.JobsListOutputFilesOptions(outputdirectoryid=output_id))
-    for file in files:
-        logger.info('Downloading {}'.format(file.name))
-        file_name = path.join(output_folder, file.name) if output_folder else file.name
-        ut.download_file(file.download_url, file_name)
-    print("All files Downloaded")
+    downloads = [(file.download_url, path.join(output_folder, file.name) if output_folder else file.name)
+                 for file in files]
+    errors = ut.download_files(downloads)
+    failed = [file_name for file_name, error in errors.items() if error is not None]
+    if failed:
+        logger.error('Failed to download {}'.format(', '.join(sorted(failed))))
+    else:
+        print("All files Downloaded")
+    return errors
+
+
+def harvest_results(workspace, experiment, job_names=None, csv_filename='results.csv', json_filename='results.json'):
+    """ Collects the training time, images/sec and accuracy of every job into one table
+
+    The executed notebooks are read from the NOTEBOOKS output of all the jobs in the experiment
+    (or job_names) concurrently, the table is printed and saved as CSV and JSON.
+    """
+    if job_names is None:
+        job_names = [job.name for job in ut.iter_jobs(client, workspace, experiment, resource_group=config.group_name)]
+    start = time.time()
+    rows = ut.harvest_results(client, config.group_name, workspace, experiment, job_names)
+    ut.write_results(rows, csv_filename=csv_filename, json_filename=json_filename)
+    for row in rows:
+        print('{job}: {framework} | epochs {epochs} | training {training_sec} sec | '
+              '{images_per_sec} images/sec | accuracy {accuracy} | error {error}'.format(**row))
+    logger.info('Harvested {} jobs in {:.1f} sec'.format(len(rows), time.time() - start))
+    return rows
 
 
 def print_job_status(workspace, experiment, job_name):
@@ -297,36 +392,106 @@ def delete_experiment(workspace, experiment):
     _ = client.experiments.delete(config.group_name, workspace, experiment).result()
 
 
+def _job_submitter(workspace, experiment, epochs, logger_url):
+    """ Uploads the scripts once and looks up the cluster, returns a function that submits one job
+    """
+    script_dir = '{}_scripts'.format(experiment)
+    _upload_job_scripts(script_dir)
+    cluster_id = current_cluster(workspace).id
+
+    def submit(job_name, prefix, image_name):
+        command = COMMAND_TEMPLATE.format(input_nb='{}_CIFAR.ipynb'.format(prefix),
+                                          output_nb='{}_{}.ipynb'.format(prefix, job_name),
+                                          epochs=epochs,
+                                          logger_url=logger_url)
+        ut.create_job(config, cluster_id, workspace, experiment, job_name, image_name, command,
+                      script_dir=script_dir, client=client)
+    return submit
+
+
+def submit_jobs(workspace, experiment, jobs=FRAMEWORK_JOBS, epochs=5, logger_url=LOGGER_URL,
+                max_workers=SUBMISSION_WORKERS):
+    """ Submits several jobs concurrently
+
+    The cluster is looked up and the scripts are uploaded once for all the jobs, then the jobs are
+    created from a pool of max_workers threads.
+
+    Parameters
+    ----------
+    jobs:  [list] (job name, notebook prefix, docker image) tuples, see FRAMEWORK_JOBS
+
+    Returns a dictionary with the error for each job (None if it was submitted) and the total
+    submission time in seconds
+    """
+    start = time.time()
+    submit = _job_submitter(workspace, experiment, epochs, logger_url)
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict((executor.submit(submit, *job), job[0]) for job in jobs)
+        for future in as_completed(futures):
+            job_name = futures[future]
+            error = future.exception()
+            errors[job_name] = None if error is None else str(error)
+            if error is None:
+                logger.info('Submitted job {}'.format(job_name))
+            else:
+                logger.error('Failed to submit job {}: {}'.format(job_name, error))
+    total_sec = time.time() - start
+    logger.info('Submitted {} of {} jobs in {:.1f} sec'.format(sum(error is None for error in errors.values()),
+                                                                len(errors),
+                                                                total_sec))
+    return {'jobs': errors, 'total_sec': total_sec}
+
+
+def run_queue(workspace, experiment, jobs=FRAMEWORK_JOBS, epochs=5, logger_url=LOGGER_URL,
+              polling_interval=ut.POLLING_INTERVAL_SEC, max_polling_interval=ut.MAX_POLLING_INTERVAL_SEC):
+    """ Submits the jobs one at a time as the cluster has idle nodes for them and waits for them all
+
+    Unlike submit_all nothing waits in the service queue, a pending job is sent as soon as a node
+    is free. Returns the summary of ut.run_job_queue, with the makespan and node utilization.
+    """
+    submit = _job_submitter(workspace, experiment, epochs, logger_url)
+    submissions = [(job[0], partial(submit, *job)) for job in jobs]
+    summary = ut.run_job_queue(client, config.group_name, workspace, experiment, config.cluster_name, submissions,
+                               polling_interval=polling_interval, max_polling_interval=max_polling_interval)
+    print('Makespan: {:.1f} sec | node utilization: {:.0%} of {} nodes'.format(summary['makespan_sec'],
+                                                                             summary['utilization'],
+                                                                             summary['nodes']))
+    return summary
+
+
 def submit_all(workspace, experiment, epochs=5, logger_url=LOGGER_URL):
     """ Submits all jobs
     """
-    jobs = (submit_cntk_job,
-            submit_chainer_job,
-            submit_mxnet_job,
-            submit_keras_cntk_job,
-            submit_keras_tf_job,
-            submit_caffe2_job,
-            submit_pytorch_job,
-            submit_tf_job,
-            submit_gluon_job)
+    return submit_jobs(workspace, experiment, epochs=epochs, logger_url=logger_url)
+
+
+def delete_all_jobs( workspace, experiment, states=None):
+    """ Deletes all jobs sent to the cluster, or those in the execution states given
+
+    Waits until they are deleted and returns the error for each job, None if it was deleted
+    """
+    return ut.delete_all_jobs_for(config.group_name,  workspace, experiment, client, states=states)
 
-    for job in jobs:
-        job(workspace, experiment, epochs=epochs, logger_url=logger_url)
 
+def teardown(workspace, experiment, remove_cluster=True, remove_experiment=True, remove_workspace=False):
+    """ Deletes all jobs then the cluster, the experiment and the workspace, each after the previous one is gone
 
-def delete_all_jobs( workspace, experiment):
-    """ Deletes all jobs sent to the cluster
+    Returns the error for each job and resource, None if it was deleted
     """
-    ut.delete_all_jobs_for(config.group_name,  workspace, experiment, client)
+    return ut.teardown(client, config.group_name, workspace, experiment,
+                       cluster_name=config.cluster_name if remove_cluster else None,
+                       delete_experiment=remove_experiment,
+                       delete_workspace=remove_workspace)
 
 
-def print_jobs( workspace, experiment):
-    """ Print information for all jobs
+def print_jobs( workspace, experiment, states=None):
+    """ Print information for all jobs, or those in the execution states given e.g. 'failed'
     """
-    ut.print_jobs_for( workspace, experiment, client, resource_group=config.group_name)
+    ut.print_jobs_for( workspace, experiment, client, resource_group=config.group_name, states=states)
 
 
-def print_jobs_summary(workspace, experiment):
-    """ Prints a summary of current jobs submitted to the cluster
+def print_jobs_summary(workspace, experiment, states=None):
+    """ Prints a summary of current jobs submitted to the cluster, or those in the execution states given
     """
-    ut.print_jobs_summary_for(workspace, experiment,client, resource_group=config.group_name)
\ No newline at end of file
+    ut.print_jobs_summary_for(workspace, experiment,client, resource_group=config.group_name, states=states)
\ No newline at end of file
@@ -1,14 +1,22 @@
 from __future__ import print_function
 
+import codecs
+import csv
+import hashlib
 import json
 import logging
 import os
 import pprint
+import re
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import azure.mgmt.batchai as training
 import azure.mgmt.batchai.models as models
 import requests
+from requests.adapters import HTTPAdapter
 from azure.common.credentials import ServicePrincipalCredentials
 from azure.storage.file import FileService
 
@@ -16,6 +24,47 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 POLLING_INTERVAL_SEC = 5
+MAX_POLLING_INTERVAL_SEC = 60
+TERMINAL_STATES = (models.ExecutionState.succeeded, models.ExecutionState.failed)
+UPLOAD_WORKERS = 8
+UPLOAD_MANIFEST = '.upload_manifest.json'
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_CHUNK_SIZE = 512 * 1024
+DOWNLOAD_PART_SIZE = 16 * 1024 * 1024
+DOWNLOAD_TIMEOUT_SEC = 60
+DOWNLOAD_PROGRESS_INTERVAL_SEC = 1
+STREAM_MIN_INTERVAL_SEC = 1
+STREAM_MAX_INTERVAL_SEC = 30
+HARVEST_WORKERS = 9
+RESULT_FIELDS = ('job', 'framework', 'epochs', 'training_sec', 'images_per_sec', 'accuracy', 'notebook', 'error')
+# What the notebooks print, read back from their outputs by notebook_metrics
+TRAINING_TIME_PATTERN = re.compile(r'^Training took ([0-9.]+) sec', re.MULTILINE)
+ACCURACY_PATTERN = re.compile(r'^Accuracy:\s+([0-9.eE+-]+)', re.MULTILINE)
+TRAIN_SHAPE_PATTERN = re.compile(r'^\((\d+), ', re.MULTILINE)
+EPOCHS_PATTERN = re.compile(r'^EPOCHS\s*=\s*(\d+)', re.MULTILINE)
+WALL_TIME_PATTERN = re.compile(r'^Wall time: (.*)$', re.MULTILINE)
+TIME_UNITS = {'d': 86400, 'h': 3600, 'min': 60, 's': 1, 'ms': 1e-3, 'us': 1e-6, u'\u00b5s': 1e-6, 'ns': 1e-9}
+# Job listings are shared by the helpers for this long, see iter_jobs
+JOBS_CACHE_TTL_SEC = 10
+JOBS_PAGE_SIZE = 1000
+DELETE_WORKERS = 8
+# Credentials are renewed this long before their token expires
+TOKEN_EXPIRY_MARGIN_SEC = 300
+
+# Called with client_id, secret and tenant to authenticate, replaceable to run without Azure
+credentials_factory = ServicePrincipalCredentials
+# Create the Batch AI client, the storage file service and the HTTP session, see fake_batchai
+client_factory = training.BatchAIManagementClient
+file_service_factory = FileService
+session_factory = requests.Session
+_clients = {}
+_clients_lock = threading.Lock()
+
+_session = None
+_session_lock = threading.Lock()
+
+_jobs_cache = {}
+_jobs_cache_lock = threading.Lock()
 
 
 def encode(value):
@@ -51,10 +100,16 @@ class Configuration(object):
 
 
 class OutputStreamer:
-    """Helper class to stream (tail -f) job's output files."""
+    """Helper class to stream (tail -f) job's output files.
+
+    Bytes are decoded incrementally so multi-byte characters split across reads come out whole.
+    If a prefix is given output is printed a whole line at a time, each preceded by prefix.
+    While no new output arrives the polling interval doubles up to STREAM_MAX_INTERVAL_SEC,
+    tail calls in between return at once.
+    """
 
     def __init__(self, client, resource_group, workspace, experiment, job_name, output_directory_id,
-                 file_name):
+                 file_name, prefix=None, session=None):
         self.client = client
         self.resource_group = resource_group
         self.job_name = job_name
@@ -64,29 +119,81 @@ class OutputStreamer:
         self.downloaded = 0
         self.workspace=workspace
         self.experiment=experiment
+        self.prefix = prefix
+        self.session = session
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._pending = ''
+        self._interval = 0
+        self._next_poll = 0
         # if no output_directory_id or file_name specified, the tail call is
         # nope
         if self.output_directory_id is None or self.file_name is None:
-            self.tail = lambda: None
+            self.tail = lambda force=False: False
 
-    def tail(self):
+    def _find_url(self):
+        files = self.client.jobs.list_output_files(
+            self.resource_group, self.workspace, self.experiment, self.job_name,
+            models.JobsListOutputFilesOptions(
+                outputdirectoryid=self.output_directory_id))
+        for f in list(files or []):
+            if f.name == self.file_name:
+                self.url = f.download_url
+
+    def _print(self, text, flush=False):
+        if self.prefix:
+            # Hold back an incomplete last line so lines from different files do not mix
+            lines = (self._pending + text).splitlines(True)
+            self._pending = ''
+            if lines and not lines[-1].endswith('\n') and not flush:
+                self._pending = lines.pop()
+            text = ''.join(self.prefix + line for line in lines)
+        print(text, end='')
+
+    def tail(self, force=False):
+        """Prints new output, returns True if there was any. force ignores the backoff."""
+        if not force and time.time() < self._next_poll:
+            return False
         if not self.url:
-            files = self.client.jobs.list_output_files(
-                self.resource_group, self.workspace, self.experiment, self.job_name,
-                models.JobsListOutputFilesOptions(
-                    outputdirectoryid=self.output_directory_id))
-            if not files:
-                return
-            else:
-                for f in list(files):
-                    if f.name == self.file_name:
-                        self.url = f.download_url
+            self._find_url()
+        received = False
         if self.url:
-            r = requests.get(self.url, headers={
-                'Range': 'bytes={0}-'.format(self.downloaded)})
+            session = self.session or http_session()
+            r = session.get(self.url, headers={
+                'Range': 'bytes={0}-'.format(self.downloaded)}, timeout=DOWNLOAD_TIMEOUT_SEC)
             if int(r.status_code / 100) == 2:
-                self.downloaded += len(r.content)
-                print(r.content.decode(), end='')
+                # A server that ignores the range sends the whole file again
+                content = r.content if r.status_code == 206 else r.content[self.downloaded:]
+                if content:
+                    self.downloaded += len(content)
+                    self._print(self._decoder.decode(content), flush=force)
+                    received = True
+        if force and not received and self._pending:
+            self._print('', flush=True)
+        if received:
+            self._interval = STREAM_MIN_INTERVAL_SEC
+        else:
+            self._interval = min(max(self._interval * 2, STREAM_MIN_INTERVAL_SEC), STREAM_MAX_INTERVAL_SEC)
+        self._next_poll = time.time() + self._interval
+        return received
+
+
+class MultiOutputStreamer(object):
+    """Tails several OutputStreamers together, e.g. stdout and stderr of many jobs."""
+
+    def __init__(self, streamers):
+        self.streamers = list(streamers)
+
+    @classmethod
+    def for_jobs(cls, client, resource_group, workspace, experiment, job_names,
+                 output_directory_id='stdOuterr', file_names=('stdout.txt', 'stderr.txt')):
+        """Follows file_names of every job, prefixing each line with the job and file name"""
+        return cls(OutputStreamer(client, resource_group, workspace, experiment, job_name,
+                                  output_directory_id, file_name,
+                                  prefix='[{0} {1}] '.format(job_name, file_name))
+                   for job_name in job_names for file_name in file_names)
+
+    def tail(self, force=False):
+        return any([streamer.tail(force) for streamer in self.streamers])
 
 
 # def client_from(configuration):
@@ -102,25 +209,269 @@ class OutputStreamer:
 #     return client
 
 
+def _token_expired(credentials):
+    token = getattr(credentials, 'token', None) or {}
+    expires_on = token.get('expires_on')
+    return expires_on is not None and float(expires_on) - TOKEN_EXPIRY_MARGIN_SEC < time.time()
+
+
 def client_from(configuration):
-    client = training.BatchAIManagementClient(
-			credentials = ServicePrincipalCredentials(client_id=configuration.client_id, secret=configuration.secret, tenant=configuration.tenant),
-			subscription_id = configuration.subscription_id)
-    return client
+    """ Returns a Batch AI client for the configuration
 
+    Clients and their credentials are cached per service principal and subscription and reused
+    until the token is about to expire, so only the first call fetches a token.
+    """
+    key = (configuration.client_id, configuration.tenant, configuration.subscription_id)
+    with _clients_lock:
+        client, credentials = _clients.get(key, (None, None))
+        if client is None or _token_expired(credentials):
+            credentials = credentials_factory(client_id=configuration.client_id,
+                                              secret=configuration.secret,
+                                              tenant=configuration.tenant)
+            client = client_factory(credentials=credentials, subscription_id=configuration.subscription_id)
+            _clients[key] = (client, credentials)
+        return client
 
-def download_file(sas, destination):
-    dir_name = os.path.dirname(destination)
-    if dir_name:
-        os.makedirs(dir_name, exist_ok=True)
-    print('Downloading {0} ...'.format(sas), end='')
-    r = requests.get(sas, stream=True)
+
+def http_session():
+    """ Returns the requests session shared by all downloads so connections are reused
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = session_factory()
+            adapter = HTTPAdapter(pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS * DOWNLOAD_WORKERS)
+            _session.mount('http://', adapter)
+            _session.mount('https://', adapter)
+        return _session
+
+
+def _download_stream(session, sas, destination):
+    r = session.get(sas, stream=True, timeout=DOWNLOAD_TIMEOUT_SEC)
+    r.raise_for_status()
     with open(destination, 'wb') as f:
-        for chunk in r.iter_content(chunk_size=512 * 1024):
+        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
             if chunk:  # filter out keep-alive new chunks
                 f.write(chunk)
-    f.close()
-    print('Done')
+
+
+def _load_download_progress(progress_file, size, part_size):
+    try:
+        with open(progress_file, 'r') as f:
+            progress = json.load(f)
+        if progress['size'] == size and progress['part_size'] == part_size and isinstance(progress['written'], dict):
+            return progress
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass  # Missing or unreadable, the download starts over
+    return {'size': size, 'part_size': part_size, 'written': {}}
+
+
+def _save_download_progress(progress, progress_file):
+    # Written aside and renamed over the old one so an interrupted write leaves the previous progress
+    tmp_file = progress_file + '.tmp'
+    write_json_to_file(progress, tmp_file)
+    os.replace(tmp_file, progress_file)
+
+
+def _download_ranges(session, sas, destination, size, part_size, max_workers):
+    partial = destination + '.partial'
+    progress_file = partial + '.json'
+    progress = _load_download_progress(progress_file, size, part_size)
+    if not progress['written'] or not os.path.exists(partial):
+        progress['written'] = {}
+        with open(partial, 'wb') as f:
+            f.truncate(size)
+    lock = threading.Lock()
+    saved = [time.time()]
+
+    def save(force=False):
+        # Called with lock held, the sidecar is rewritten at most every DOWNLOAD_PROGRESS_INTERVAL_SEC
+        if force or time.time() - saved[0] >= DOWNLOAD_PROGRESS_INTERVAL_SEC:
+            _save_download_progress(progress, progress_file)
+            saved[0] = time.time()
+
+    def fetch(start):
+        end = min(start + part_size, size)
+        offset = start + progress['written'].get(str(start), 0)
+        if offset >= end:
+            return
+        r = session.get(sas, headers={'Range': 'bytes={0}-{1}'.format(offset, end - 1)}, stream=True,
+                        timeout=DOWNLOAD_TIMEOUT_SEC)
+        r.raise_for_status()
+        if r.status_code != 206:
+            raise IOError('Range request for {0} was not honoured'.format(sas))
+        with open(partial, 'r+b') as f:
+            f.seek(offset)
+            try:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    if chunk:
+                        f.write(chunk)
+                        f.flush()
+                        offset += len(chunk)
+                        with lock:
+                            progress['written'][str(start)] = offset - start
+                            save()
+            finally:
+                with lock:
+                    save(force=True)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(fetch, range(0, size, part_size)))
+    os.replace(partial, destination)
+    for filename in (progress_file, progress_file + '.tmp'):
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def download_file(sas, destination, session=None, part_size=DOWNLOAD_PART_SIZE, max_workers=DOWNLOAD_WORKERS):
+    """ Downloads sas to destination
+
+    Files the server can serve in ranges are fetched in part_size pieces by up to max_workers
+    threads and an interrupted download resumes where it stopped. A destination that already has
+    the size of the remote file is skipped.
+    """
+    dir_name = os.path.dirname(destination)
+    if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+    session = session or http_session()
+    head = session.head(sas, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT_SEC)
+    head.raise_for_status()
+    size = int(head.headers.get('Content-Length', -1))
+    if size >= 0 and os.path.exists(destination) and os.path.getsize(destination) == size:
+        print('Skipping {0}, already downloaded'.format(destination))
+        return
+    print('Downloading {0} ...'.format(sas))
+    if size > 0 and head.headers.get('Accept-Ranges') == 'bytes':
+        _download_ranges(session, sas, destination, size, part_size, max_workers)
+    else:
+        _download_stream(session, sas, destination)
+    print('Done {0}'.format(destination))
+
+
+def download_files(downloads, max_workers=DOWNLOAD_WORKERS, session=None):
+    """ Downloads (sas, destination) pairs concurrently over one session
+
+    Returns a dictionary with the error for each destination, None if it was downloaded
+    """
+    session = session or http_session()
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict((executor.submit(download_file, sas, destination, session=session), destination)
+                       for sas, destination in downloads)
+        for future in as_completed(futures):
+            error = future.exception()
+            errors[futures[future]] = None if error is None else str(error)
+            if error is not None:
+                logger.error('Failed to download {0}: {1}'.format(futures[future], error))
+    return errors
+
+
+def _text(value):
+    return ''.join(value) if isinstance(value, list) else value
+
+
+def _last_match(pattern, text, cast):
+    matches = pattern.findall(text)
+    return cast(matches[-1]) if matches else None
+
+
+def _wall_time_sec(text):
+    # As %%time prints it, e.g. 4min 33s or 743 ms
+    matches = WALL_TIME_PATTERN.findall(text)
+    if not matches:
+        return None
+    parts = re.findall(r'([0-9.]+)\s*([^\s0-9.]+)', matches[-1])
+    return sum(float(value) * TIME_UNITS.get(unit, 0) for value, unit in parts) or None
+
+
+def _cell_text(cell):
+    return ''.join(_text(output.get('text', '')) for output in cell.get('outputs', [])
+                   if output.get('output_type') == 'stream')
+
+
+def notebook_metrics(notebook):
+    """ Returns the epochs, training time, images/sec and accuracy printed by an executed notebook
+
+    EPOCHS is the last value assigned in the code, so the one papermill injected, and the number of
+    training images is the first dimension of the training set shape. Missing values are None and
+    error holds the first exception raised while the notebook ran.
+    """
+    cells = [cell for cell in notebook.get('cells', []) if cell.get('cell_type') == 'code']
+    source = '\n'.join(_text(cell.get('source', '')) for cell in cells)
+    outputs = [output for cell in cells for output in cell.get('outputs', [])]
+    text = ''.join(_cell_text(cell) for cell in cells)
+    errors = ['{0}: {1}'.format(output.get('ename'), output.get('evalue'))
+              for output in outputs if output.get('output_type') == 'error']
+    epochs = _last_match(EPOCHS_PATTERN, source, int)
+    training_sec = _last_match(TRAINING_TIME_PATTERN, text, float)
+    if training_sec is None:
+        # Notebooks run before the training time was printed only have the %%time output
+        training_cells = [cell for cell in cells if 'Timer()' in _text(cell.get('source', ''))]
+        training_sec = _wall_time_sec(_cell_text(training_cells[-1])) if training_cells else None
+    shapes = TRAIN_SHAPE_PATTERN.findall(text)
+    images_per_sec = None
+    if epochs and training_sec and shapes:
+        images_per_sec = epochs * int(shapes[0]) / training_sec
+    return {'epochs': epochs,
+            'training_sec': training_sec,
+            'images_per_sec': images_per_sec,
+            'accuracy': _last_match(ACCURACY_PATTERN, text, float),
+            'error': errors[0] if errors else None}
+
+
+def _harvest_job(client, resource_group, workspace, experiment, job_name, output_directory_id, session):
+    files = client.jobs.list_output_files(resource_group, workspace, experiment, job_name,
+                                          models.JobsListOutputFilesOptions(outputdirectoryid=output_directory_id))
+    notebooks = [f for f in files or [] if f.name.endswith('.ipynb')]
+    if not notebooks:
+        raise IOError('No notebook in the {0} output of {1}'.format(output_directory_id, job_name))
+    r = session.get(notebooks[0].download_url, timeout=DOWNLOAD_TIMEOUT_SEC)
+    r.raise_for_status()
+    result = notebook_metrics(json.loads(r.content.decode('utf-8')))
+    # Notebooks are written as <framework>_<job name>.ipynb
+    suffix = '_{0}.ipynb'.format(job_name)
+    name = notebooks[0].name
+    result.update(job=job_name,
+                  notebook=name,
+                  framework=name[:-len(suffix)] if name.endswith(suffix) else name[:-len('.ipynb')])
+    return result
+
+
+def harvest_results(client, resource_group, workspace, experiment, job_names, output_directory_id='NOTEBOOKS',
+                    max_workers=HARVEST_WORKERS, session=None):
+    """ Fetches the executed notebook of every job concurrently and returns one row of metrics per job
+
+    The notebooks are read in memory, nothing is written to disk. Rows have the RESULT_FIELDS,
+    a job whose notebook could not be read has only its error filled in.
+    """
+    session = session or http_session()
+    rows = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict((executor.submit(_harvest_job, client, resource_group, workspace, experiment, job_name,
+                                        output_directory_id, session), job_name)
+                       for job_name in job_names)
+        for future in as_completed(futures):
+            error = future.exception()
+            if error is None:
+                rows.append(future.result())
+            else:
+                logger.error('Failed to harvest {0}: {1}'.format(futures[future], error))
+                rows.append({'job': futures[future], 'error': str(error)})
+    rows = [dict((field, row.get(field)) for field in RESULT_FIELDS) for row in rows]
+    return sorted(rows, key=lambda row: row['job'])
+
+
+def write_results(rows, csv_filename=None, json_filename=None):
+    """ Writes rows from harvest_results as a CSV table and as a JSON list
+    """
+    if csv_filename:
+        with open(csv_filename, 'w') as f:
+            writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+    if json_filename:
+        with open(json_filename, 'w') as f:
+            json.dump(rows, f, indent=2)
 
 
 def print_job_status(job):
@@ -145,12 +496,32 @@ def print_job_status(job):
         print('FailureDetails: {0}'.format(failure_message))
 
 
+def _auto_scale(cluster):
+    return getattr(cluster.scale_settings, 'auto_scale', None)
+
+
+def _minimum_node_count(cluster):
+    """ Nodes the cluster keeps without any jobs, the target of a manually scaled cluster
+    """
+    auto_scale = _auto_scale(cluster)
+    if auto_scale is not None:
+        return auto_scale.minimum_node_count
+    return cluster.scale_settings.manual.target_node_count
+
+
+def _scale_target(cluster):
+    auto_scale = _auto_scale(cluster)
+    if auto_scale is not None:
+        return 'auto {0}-{1}'.format(auto_scale.minimum_node_count, auto_scale.maximum_node_count)
+    return cluster.scale_settings.manual.target_node_count
+
+
 def print_cluster_status(cluster):
     print(
         'Cluster state: {0} Target: {1}; Allocated: {2}; Idle: {3}; '
         'Unusable: {4}; Running: {5}; Preparing: {6}; Leaving: {7}'.format(
             cluster.allocation_state,
-            cluster.scale_settings.manual.target_node_count,
+            _scale_target(cluster),
             cluster.current_node_count,
             cluster.node_state_counts.idle_node_count,
             cluster.node_state_counts.unusable_node_count,
@@ -167,16 +538,27 @@ def print_cluster_status(cluster):
                 print('{0}: {1}'.format(detail.name, detail.value))
 
 
-def wait_for_cluster(config, resource_group, workspace, cluster_name, polling_interval=POLLING_INTERVAL_SEC):
+def wait_for_cluster(config, resource_group, workspace, cluster_name, polling_interval=POLLING_INTERVAL_SEC,
+                     min_ready_nodes=1):
+    """ Waits until min_ready_nodes nodes are idle, enough for the first job, and returns the cluster
+
+    min_ready_nodes is capped by the nodes the cluster keeps without jobs, so an auto-scale cluster
+    with no minimum is returned at once. Pass None to wait until every node is allocated and
+    prepared. Returns early if the cluster reports errors.
+    """
     client = client_from(config)
     while True:
         try:
             cluster = client.clusters.get(resource_group, workspace, cluster_name)
             print_cluster_status(cluster)
-            if (cluster.scale_settings.manual.target_node_count == cluster.current_node_count
-                and cluster.node_state_counts.preparing_node_count == 0 and
-                cluster.node_state_counts.idle_node_count > 0 or
-                    cluster.errors):
+            counts = cluster.node_state_counts
+            nodes = _minimum_node_count(cluster)
+            if min_ready_nodes is None:
+                ready = (nodes == cluster.current_node_count and counts.preparing_node_count == 0 and
+                         (counts.idle_node_count > 0 or nodes == 0))
+            else:
+                ready = counts.idle_node_count >= min(min_ready_nodes, nodes)
+            if ready or cluster.errors:
                 return cluster
         except:
             pass
@@ -207,30 +589,242 @@ def wait_for_job_completion(client, resource_group, workspace, experiment, job_n
     while True:
         streamer.tail()
         job = client.jobs.get(resource_group, workspace, experiment, job_name)
-        if job.execution_state == models.ExecutionState.succeeded:
+        if job.execution_state in TERMINAL_STATES:
             break
         time.sleep(1)
-    streamer.tail()
+    streamer.tail(force=True)
     print_job_status(job)
 
 
-def upload_scripts(config, job_name, filenames):
-    service = FileService(config.storage_account['name'],
-                          config.storage_account['key'])
+def _seconds_between(start, end):
+    if start is None or end is None:
+        return None
+    return (end - start).total_seconds()
+
+
+class _JobWatch(object):
+    """Tracks the state of one job as seen by monitor_jobs."""
+
+    def __init__(self, name, now):
+        self.name = name
+        self.state = None
+        self.exit_code = None
+        self.first_seen = now
+        self.started = None
+        self.finished = None
+        self.queued_sec = None
+        self.running_sec = None
+
+    def update(self, job, now):
+        """Returns True if the job changed state"""
+        changed = job.execution_state != self.state
+        self.state = job.execution_state
+        if self.started is None and self.state != models.ExecutionState.queued:
+            self.started = now
+        if self.finished is None and self.state in TERMINAL_STATES:
+            self.finished = now
+        info = job.execution_info
+        if info is not None:
+            self.exit_code = info.exit_code
+        # Prefer the service timestamps, fall back to what the monitor observed
+        start_time = info.start_time if info is not None else None
+        end_time = info.end_time if info is not None else None
+        self.queued_sec = _seconds_between(job.creation_time, start_time)
+        if self.queued_sec is None and self.started is not None:
+            self.queued_sec = self.started - self.first_seen
+        self.running_sec = _seconds_between(start_time, end_time)
+        if self.running_sec is None and self.started is not None:
+            self.running_sec = (self.finished or now) - self.started
+        return changed
+
+    def as_dict(self):
+        return {'state': self.state,
+                'exit_code': self.exit_code,
+                'queued_sec': self.queued_sec,
+                'running_sec': self.running_sec}
+
+
+def monitor_jobs(client, resource_group, workspace, experiment, job_names, cluster_name,
+                 polling_interval=POLLING_INTERVAL_SEC, max_polling_interval=MAX_POLLING_INTERVAL_SEC,
+                 streamer=None):
+    """
+    Waits for all the jobs in job_names to reach a terminal state.
+
+    Every iteration fetches the cluster status once and then polls only the jobs that are still
+    active. The interval starts at polling_interval and doubles up to max_polling_interval while
+    nothing changes, resetting whenever a job changes state. If a streamer (e.g. a
+    MultiOutputStreamer) is given its new output is printed on every iteration. Returns a
+    dictionary with the state, exit code and seconds spent queued and running for each job.
+    """
+    watches = dict((name, _JobWatch(name, time.time())) for name in job_names)
+    interval = polling_interval
+    while True:
+        cluster = client.clusters.get(resource_group, workspace, cluster_name)
+        print_cluster_status(cluster)
+        active = [watch for watch in watches.values() if watch.state not in TERMINAL_STATES]
+        changed = False
+        for watch in active:
+            job = client.jobs.get(resource_group, workspace, experiment, watch.name)
+            if watch.update(job, time.time()):
+                changed = True
+                print('{0}: {1}'.format(watch.name, watch.state))
+                if watch.state in TERMINAL_STATES:
+                    print_job_status(job)
+        if streamer is not None:
+            streamer.tail()
+        if all(watch.state in TERMINAL_STATES for watch in watches.values()):
+            break
+        interval = polling_interval if changed else min(interval * 2, max_polling_interval)
+        time.sleep(interval)
+    if streamer is not None:
+        streamer.tail(force=True)
+    return dict((name, watch.as_dict()) for name, watch in watches.items())
+
+
+def _cluster_failure(cluster):
+    if cluster.errors:
+        return '; '.join('{0}: {1}'.format(error.code, error.message) for error in cluster.errors)
+    counts = cluster.node_state_counts
+    if cluster.current_node_count and (counts.unusable_node_count or 0) >= cluster.current_node_count:
+        return 'all {0} nodes are unusable'.format(cluster.current_node_count)
+    return None
+
+
+def _queue_capacity(cluster, watches):
+    """ Number of jobs run_job_queue can submit now
+
+    A manually scaled cluster takes one job per idle node, less the jobs submitted that have not
+    started yet. An auto-scale cluster only grows for queued jobs, so it takes jobs up to its
+    maximum node count. At least one job is allowed when none is outstanding, so a cluster without
+    idle nodes still gets work.
+    """
+    outstanding = [watch for watch in watches if watch.state not in TERMINAL_STATES]
+    auto_scale = _auto_scale(cluster)
+    if auto_scale is not None:
+        capacity = auto_scale.maximum_node_count - len(outstanding)
+    else:
+        waiting = sum(1 for watch in outstanding if watch.state in (None, models.ExecutionState.queued))
+        capacity = (cluster.node_state_counts.idle_node_count or 0) - waiting
+    return capacity if outstanding else max(capacity, 1)
+
+
+def run_job_queue(client, resource_group, workspace, experiment, cluster_name, submissions,
+                  polling_interval=POLLING_INTERVAL_SEC, max_polling_interval=MAX_POLLING_INTERVAL_SEC):
+    """
+    Submits jobs in order as the cluster has room for them and waits for all of them to finish.
+
+    submissions is a list of (job name, function that submits the job) for one node jobs. On every
+    iteration the active jobs are polled, then as many pending jobs are submitted as _queue_capacity
+    allows. Raises RuntimeError if the cluster reports errors or all its nodes are unusable, as the
+    jobs would never start. Polling backs off like monitor_jobs. Returns a dictionary with the jobs
+    as monitor_jobs does (plus the error of those that could not be submitted), the makespan from the
+    first submission to the last job finishing, the largest number of nodes seen and the fraction of
+    node time spent running jobs.
+    """
+    pending = list(submissions)
+    watches = {}
+    errors = {}
+    nodes = 0
+    start = time.time()
+    interval = polling_interval
+    while True:
+        changed = False
+        for watch in [watch for watch in watches.values() if watch.state not in TERMINAL_STATES]:
+            job = client.jobs.get(resource_group, workspace, experiment, watch.name)
+            if watch.update(job, time.time()):
+                changed = True
+                print('{0}: {1}'.format(watch.name, watch.state))
+        cluster = client.clusters.get(resource_group, workspace, cluster_name)
+        failure = _cluster_failure(cluster)
+        if failure:
+            raise RuntimeError('Cluster {0} cannot run jobs: {1}'.format(cluster_name, failure))
+        nodes = max(nodes, cluster.current_node_count or 0)
+        capacity = _queue_capacity(cluster, watches.values()) if pending else 0
+        while pending and capacity > 0:
+            job_name, submit = pending.pop(0)
+            try:
+                submit()
+            except Exception as error:
+                logger.error('Failed to submit job {0}: {1}'.format(job_name, error))
+                errors[job_name] = str(error)
+                continue
+            logger.info('Submitted job {0}'.format(job_name))
+            watches[job_name] = _JobWatch(job_name, time.time())
+            capacity -= 1
+            changed = True
+        if not pending and all(watch.state in TERMINAL_STATES for watch in watches.values()):
+            break
+        interval = polling_interval if changed else min(interval * 2, max_polling_interval)
+        time.sleep(interval)
+
+    finished = [watch.finished for watch in watches.values() if watch.finished is not None]
+    makespan = (max(finished) if finished else time.time()) - start
+    busy = sum(watch.running_sec or 0 for watch in watches.values())
+    jobs = dict((name, watch.as_dict()) for name, watch in watches.items())
+    jobs.update((name, {'state': None, 'exit_code': None, 'queued_sec': None, 'running_sec': None, 'error': error})
+                for name, error in errors.items())
+    return {'jobs': jobs,
+            'makespan_sec': makespan,
+            'nodes': nodes,
+            'utilization': busy / (nodes * makespan) if nodes and makespan > 0 else 0.0}
+
+
+def _file_digest(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_upload_manifest(service, share, directory):
+    if not service.exists(share, directory_name=directory, file_name=UPLOAD_MANIFEST):
+        return {}
+    return json.loads(service.get_file_to_text(share, directory, UPLOAD_MANIFEST).content)
+
+
+def upload_scripts(config, job_name, filenames, max_workers=UPLOAD_WORKERS, service=None):
+    """ Uploads the files to the job_name directory of the fileshare
+
+    A manifest of content hashes is kept next to the files so only new or changed files are sent,
+    using up to max_workers concurrent uploads. Returns the number of files and bytes sent and skipped.
+    """
+    service = service or file_service_factory(config.storage_account['name'],
+                                              config.storage_account['key'])
     if not service.exists(config.fileshare_name, directory_name=job_name):
         service.create_directory(config.fileshare_name, job_name, fail_on_exist=False)
+        manifest = {}
+    else:
+        manifest = _read_upload_manifest(service, config.fileshare_name, job_name)
+
+    digests = dict((os.path.basename(fname), (fname, _file_digest(fname))) for fname in filenames)
+    changed = [fname for name, (fname, digest) in digests.items() if manifest.get(name) != digest]
     trasfer_file = lambda fname: service.create_file_from_path(config.fileshare_name, job_name, os.path.basename(fname), fname)
-    for filename in filenames:
-        trasfer_file(filename)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(trasfer_file, changed))
 
+    manifest.update((name, digest) for name, (_, digest) in digests.items())
+    service.create_file_from_text(config.fileshare_name, job_name, UPLOAD_MANIFEST, json.dumps(manifest))
+    bytes_sent = sum(os.path.getsize(fname) for fname in changed)
+    stats = {'files_sent': len(changed),
+             'files_skipped': len(digests) - len(changed),
+             'bytes_sent': bytes_sent,
+             'bytes_skipped': sum(os.path.getsize(fname) for fname, _ in digests.values()) - bytes_sent}
+    logger.info('Uploaded {files_sent} files ({bytes_sent} bytes) to {0}, '
+                'skipped {files_skipped} unchanged files ({bytes_skipped} bytes)'.format(job_name, **stats))
+    return stats
 
-def create_job(config, cluster_id, workspace, experiment, job_name, image_name, command, number_of_vms=1):
+
+def create_job(config, cluster_id, workspace, experiment, job_name, image_name, command, number_of_vms=1,
+               script_dir=None, client=None):
     ''' Creates job
+
+    The scripts are read from the script_dir directory of the fileshare, which defaults to job_name.
     '''
     input_directories = [
         models.InputDirectory(
             id='SCRIPT',
-            path='$AZ_BATCHAI_MOUNT_ROOT/{0}/{1}'.format(config.fileshare_mount_point, job_name)),
+            path='$AZ_BATCHAI_MOUNT_ROOT/{0}/{1}'.format(config.fileshare_mount_point, script_dir or job_name)),
         models.InputDirectory(
             id='DATASET',
             path='$AZ_BATCHAI_MOUNT_ROOT/{0}/{1}'.format(config.fileshare_mount_point, 'data'))]
@@ -258,9 +852,9 @@ def create_job(config, cluster_id, workspace, experiment, job_name, image_name,
         container_settings=models.ContainerSettings(image_source_registry=models.ImageSourceRegistry(image=image_name)),
         custom_toolkit_settings=models.CustomToolkitSettings(command_line=command))
 
-
-    client = client_from(config)
+    client = client or client_from(config)
     _ = client.jobs.create(config.group_name, workspace, experiment, job_name, parameters)
+    invalidate_jobs_cache(config.group_name, workspace, experiment)
 
 
 def wait_for_job(config, workspace, experiment, job_name):
@@ -268,14 +862,27 @@ def wait_for_job(config, workspace, experiment, job_name):
     wait_for_job_completion(client, config.group_name, workspace, experiment, job_name, config.cluster_name, 'stdOuterr', 'stdout.txt')
 
 
-def setup_cluster(config, workspace):
+def wait_for_jobs(config, workspace, experiment, job_names, stream_output=False):
+    client = client_from(config)
+    streamer = None
+    if stream_output:
+        streamer = MultiOutputStreamer.for_jobs(client, config.group_name, workspace, experiment, job_names)
+    return monitor_jobs(client, config.group_name, workspace, experiment, job_names, config.cluster_name,
+                        streamer=streamer)
+
+
+def setup_cluster(config, workspace, min_node_count=None, max_node_count=None):
+    """ Creates the cluster, auto-scaled between min_node_count and max_node_count if given, otherwise
+    as set in the configuration, see scale_settings_for
+    """
     client = client_from(config)
     container_setting_for = lambda img: models.ContainerSettings(image_source_registry=models.ImageSourceRegistry(image=img))
     container_settings = [container_setting_for(img) for img in config.image_names]
 
     volumes = create_volume(config.storage_account['name'],config.storage_account['key'], config.fileshare_name, config.fileshare_mount_point)
 
-    parameters = cluster_parameters_for(config, container_settings, volumes)
+    parameters = cluster_parameters_for(config, container_settings, volumes, min_node_count=min_node_count,
+                                        max_node_count=max_node_count)
     _ = client.clusters.create(config.group_name, workspace, config.cluster_name, parameters)
 
 
@@ -299,7 +906,28 @@ def create_volume(storage_name, storage_key, azure_file_share_name, azure_file_s
     )
 
 
-def cluster_parameters_for(config, container_settings, volumes):
+def scale_settings_for(config, min_node_count=None, max_node_count=None):
+    """ Auto-scale between min_node_count and max_node_count if the configuration has a max_node_count,
+    otherwise a fixed node_count. A max_node_count passed in takes the place of the configuration's.
+
+    An auto-scaled cluster starts with min_node_count nodes and Batch AI adds nodes for queued jobs
+    and removes idle ones, so nothing is left running once the jobs are done.
+    """
+    if not max_node_count:
+        min_node_count = getattr(config, 'min_node_count', None)
+        max_node_count = getattr(config, 'max_node_count', None)
+    if max_node_count:
+        min_node_count = min_node_count or 0
+        return models.ScaleSettings(
+            auto_scale=models.AutoScaleSettings(minimum_node_count=min_node_count,
+                                                maximum_node_count=max_node_count,
+                                                initial_node_count=min_node_count))
+    return models.ScaleSettings(
+        manual=models.ManualScaleSettings(target_node_count=config.node_count)
+    )
+
+
+def cluster_parameters_for(config, container_settings, volumes, min_node_count=None, max_node_count=None):
     return models.ClusterCreateParameters(
         virtual_machine_configuration=models.VirtualMachineConfiguration(
             image_reference=models.ImageReference(offer='UbuntuServer',
@@ -311,31 +939,160 @@ def cluster_parameters_for(config, container_settings, volumes):
         user_account_settings=models.UserAccountSettings(
             admin_user_name=config.admin_user['name'],
             admin_user_password=config.admin_user['password']),
-        scale_settings=models.ScaleSettings(
-            manual=models.ManualScaleSettings(target_node_count=config.node_count)
-        ),
+        scale_settings=scale_settings_for(config, min_node_count=min_node_count, max_node_count=max_node_count),
         node_setup=models.NodeSetup(
             mount_volumes=volumes
         )
     )
 
-def jobs_list_for(client,  workspace, experiment, resource_group=None):
-    jobs_generator = client.jobs.list_by_experiment(resource_group, workspace, experiment)
-    return [job.as_dict() for job in jobs_generator]
+
+def invalidate_jobs_cache(resource_group, workspace, experiment):
+    with _jobs_cache_lock:
+        _jobs_cache.pop((resource_group, workspace, experiment), None)
+
+
+def _listed_jobs(client, resource_group, workspace, experiment, max_age):
+    key = (resource_group, workspace, experiment)
+    with _jobs_cache_lock:
+        listed, jobs = _jobs_cache.get(key, (0, None))
+    if jobs is not None and time.time() - listed < max_age:
+        for job in jobs:
+            yield job
+        return
+    listed = time.time()
+    jobs = []
+    pages = client.jobs.list_by_experiment(resource_group, workspace, experiment,
+                                           models.JobsListByExperimentOptions(max_results=JOBS_PAGE_SIZE))
+    for job in pages:
+        jobs.append(job)
+        yield job
+    with _jobs_cache_lock:
+        _jobs_cache[key] = (listed, jobs)
+
+
+def iter_jobs(client, workspace, experiment, resource_group=None, states=None, max_age=JOBS_CACHE_TTL_SEC):
+    """ Yields the jobs of the experiment as the service returns them, page by page
+
+    A listing read to the end is kept for max_age seconds and reused by the next calls, creating or
+    deleting jobs through this module drops it. states is an execution state or a list of them to
+    keep only the jobs in those states.
+    """
+    if states is not None and not isinstance(states, (list, tuple, set)):
+        states = (states,)
+    for job in _listed_jobs(client, resource_group, workspace, experiment, max_age):
+        if states is None or job.execution_state in states:
+            yield job
+
+
+def _job_summary(job):
+    info = job.execution_info
+    return {'name': job.name,
+            'execution_state': job.execution_state,
+            'execution_info': {'exit_code': info.exit_code} if info is not None else {}}
+
+
+def jobs_list_for(client,  workspace, experiment, resource_group=None, states=None):
+    """ Returns the name, execution state and exit code of the jobs, see iter_jobs
+    """
+    return [_job_summary(job) for job in iter_jobs(client, workspace, experiment,
+                                                   resource_group=resource_group, states=states)]
 
 
-def print_jobs_for( workspace, experiment, client, resource_group=None):
-    pprint.pprint(jobs_list_for(client,  workspace, experiment, resource_group=resource_group))
+def print_jobs_for( workspace, experiment, client, resource_group=None, states=None):
+    pprint.pprint([job.as_dict() for job in iter_jobs(client, workspace, experiment,
+                                                      resource_group=resource_group, states=states)])
 
 
-def print_jobs_summary_for( workspace, experiment, client, resource_group=None):
-    for job in jobs_list_for(client,  workspace, experiment, resource_group=resource_group):
+def print_jobs_summary_for( workspace, experiment, client, resource_group=None, states=None):
+    for job in iter_jobs(client, workspace, experiment, resource_group=resource_group, states=states):
+        job = _job_summary(job)
         print('{}: status:{} | exit-code {}'.format(job['name'],
                                                      job['execution_state'],
-                                                     job.get('execution_info', dict()).get('exit_code', None)))
+                                                     job['execution_info'].get('exit_code', None)))
+
 
+def _wait_for_deletions(pollers, errors, timeout=None):
+    """ Waits on the pollers of deletions started together and records None or the error for each
 
-def delete_all_jobs_for(resource_group, workspace, experiment, client):
-    for job in jobs_list_for(client, workspace, experiment, resource_group=resource_group):
-        logger.info('Deleting {}'.format(job['name']))
-        client.jobs.delete(resource_group, workspace, experiment, job['name'])
+    timeout is for all of them together. result returns when it expires, so a deletion still
+    running then is recorded as timed out rather than deleted.
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    for key, poller in pollers.items():
+        try:
+            poller.result(None if deadline is None else max(deadline - time.time(), 0))
+            if not poller.done():
+                raise RuntimeError('Timed out after {0} sec'.format(timeout))
+            errors[key] = None
+        except Exception as error:
+            logger.error('Failed to delete {0} {1}: {2}'.format(key[0], key[1], error))
+            errors[key] = str(error)
+
+
+def delete_all_jobs_for(resource_group, workspace, experiment, client, states=None, max_workers=DELETE_WORKERS,
+                        timeout=None):
+    """ Deletes the jobs concurrently and waits until all of them are deleted
+
+    timeout limits the wait in seconds, a job still being deleted then gets a timeout error.
+    Returns an ordered dictionary with the error for each ('job', job name), None if it was deleted
+    """
+    # Names are read first so the listing does not change while it is being paged through. They are
+    # always read from the service, a cached listing would miss jobs created elsewhere since
+    job_names = [job.name for job in iter_jobs(client, workspace, experiment, resource_group=resource_group,
+                                               states=states, max_age=0)]
+    errors = OrderedDict((('job', job_name), None) for job_name in job_names)
+    pollers = OrderedDict()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = dict((executor.submit(client.jobs.delete, resource_group, workspace, experiment, job_name),
+                            ('job', job_name))
+                           for job_name in job_names)
+            for future in as_completed(futures):
+                key = futures[future]
+                error = future.exception()
+                if error is None:
+                    logger.info('Deleting {}'.format(key[1]))
+                    pollers[key] = future.result()
+                else:
+                    logger.error('Failed to delete job {0}: {1}'.format(key[1], error))
+                    errors[key] = str(error)
+        _wait_for_deletions(pollers, errors, timeout)
+    finally:
+        invalidate_jobs_cache(resource_group, workspace, experiment)
+    return errors
+
+
+def teardown(client, resource_group, workspace, experiment, cluster_name=None, delete_experiment=False,
+             delete_workspace=False, max_workers=DELETE_WORKERS, timeout=None):
+    """ Deletes the jobs of the experiment, then the cluster, the experiment and the workspace if asked
+
+    Each step waits until the previous one is done and is skipped if it failed, since an experiment
+    cannot be deleted while it has jobs nor a workspace while it has clusters or experiments.
+    Returns an ordered dictionary with the error for each (kind, name), None if it was deleted
+    """
+    errors = delete_all_jobs_for(resource_group, workspace, experiment, client, max_workers=max_workers,
+                                 timeout=timeout)
+    steps = []
+    if cluster_name:
+        steps.append((('cluster', cluster_name), lambda: client.clusters.delete(resource_group, workspace,
+                                                                                cluster_name)))
+    if delete_experiment:
+        steps.append((('experiment', experiment), lambda: client.experiments.delete(resource_group, workspace,
+                                                                                   experiment)))
+    if delete_workspace:
+        steps.append((('workspace', workspace), lambda: client.workspaces.delete(resource_group, workspace)))
+    for key, delete in steps:
+        failed = [' '.join(k) for k, error in errors.items() if error is not None]
+        if failed:
+            logger.warning('Not deleting {0} {1} because {2} failed'.format(key[0], key[1], ', '.join(failed)))
+            errors[key] = 'Skipped, {0} failed'.format(', '.join(failed))
+            continue
+        logger.info('Deleting {0} {1}'.format(*key))
+        try:
+            poller = delete()
+        except Exception as error:
+            logger.error('Failed to delete {0} {1}: {2}'.format(key[0], key[1], error))
+            errors[key] = str(error)
+            continue
+        _wait_for_deletions({key: poller}, errors, timeout)
+    return errors